@@ -1,13 +1,43 @@
 from flask import Flask
-from flask_session import Session
 from flask_cors import CORS
-from .views import auth_blueprint, spotify_blueprint
-
-app = Flask(__name__)
-app.config.from_object('config.Config')
-app.register_blueprint(auth_blueprint)
-app.register_blueprint(spotify_blueprint)
-Session(app)
-CORS(app,
-     origins=["*"],
-     supports_credentials=True)
+from .compression import compress_response
+from .sessions import create_session_interface
+from .views import auth_blueprint, jobs_blueprint, metrics_blueprint, spotify_blueprint
+from .warmup import start_worker_on_first_request
+
+
+def create_app(config_object='config.Config'):
+    """
+    Build the Flask app. Upstream clients and the OpenAI SDK are only created when first
+    used; with WARM_UP_ON_START each worker process creates them, and primes the caches, in
+    the background once it starts, and /ready reports when that is done.
+    """
+    app = Flask(__name__)
+    app.config.from_object(config_object)
+    app.register_blueprint(auth_blueprint)
+    app.register_blueprint(spotify_blueprint)
+    app.register_blueprint(jobs_blueprint)
+    app.register_blueprint(metrics_blueprint)
+    app.after_request(compress_response)
+    session_interface = create_session_interface(app.config)
+    if session_interface is not None:
+        app.session_interface = session_interface
+    else:
+        # Only the Flask-Session backends need the extension
+        from flask_session import Session
+        Session(app)
+    CORS(app,
+         origins=["*"],
+         supports_credentials=True)
+    # Background threads start per process (see warmup.start_worker), never here before a fork
+    app.before_request(start_worker_on_first_request)
+    return app
+
+
+def __getattr__(name):
+    # `from app import app` (main.py, `gunicorn app:app`) still works, building the app on first access
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,49 @@
+import gzip
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # Optional: without it responses are only gzipped
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/javascript', 'text/html', 'text/plain', 'text/css'}
+
+
+def _preferred_encoding():
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+
+def compress_response(response):
+    """
+    Compress buffered JSON and text responses with brotli or gzip, whichever the client
+    prefers. Streamed responses (NDJSON, SSE) are left alone so every event still leaves at
+    once, as are small bodies, where compression costs more than it saves.
+    """
+    config = current_app.config
+    if (not config.get('COMPRESS_RESPONSES', True)
+            or response.direct_passthrough
+            or response.is_streamed
+            or not 200 <= response.status_code < 300 or response.status_code == 204
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    encoding = _preferred_encoding()
+    if encoding is None or len(body) < config.get('COMPRESS_MIN_SIZE', 500):
+        return response
+
+    if encoding == 'br':
+        compressed = brotli.compress(body, quality=config.get('COMPRESS_BR_QUALITY', 4))
+    else:
+        compressed = gzip.compress(body, compresslevel=config.get('COMPRESS_GZIP_LEVEL', 6))
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    # The bytes now differ per encoding, so only a weak validator still holds
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
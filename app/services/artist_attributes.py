@@ -0,0 +1,126 @@
+import os
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .cache import TieredCache
+from .concurrency import bounded_map, chunked
+from .musicbrainz import get_artist_info
+
+MUSICBRAINZ_BATCH_SIZE = int(os.environ.get('MUSICBRAINZ_BATCH_SIZE', 20))
+
+# Keyed both by "spotify:<artist id>" and "name:<normalized name>"; None means MusicBrainz had no match
+artist_attribute_cache = TieredCache('artist_attributes',
+                                     max_entries=int(os.environ.get('ARTIST_ATTRIBUTE_CACHE_SIZE', 50000)),
+                                     ttl=float(os.environ.get('ARTIST_ATTRIBUTE_CACHE_TTL', 30 * 24 * 3600)),
+                                     negative_ttl=float(os.environ.get('ARTIST_ATTRIBUTE_NEGATIVE_TTL',
+                                                                       7 * 24 * 3600)))
+# For names MusicBrainz could not settle because even a lone query came back truncated
+ARTIST_ATTRIBUTE_UNSETTLED_TTL = float(os.environ.get('ARTIST_ATTRIBUTE_UNSETTLED_TTL', 6 * 3600))
+
+
+def normalize_artist_name(name: str) -> str:
+    return " ".join(name.casefold().split())
+
+
+def _attributes(musicbrainz_artist: Dict) -> Dict:
+    gender = musicbrainz_artist.get('gender')
+    return {
+        'mbid': musicbrainz_artist.get('id'),
+        'gender': gender.casefold() if gender else None,
+        'type': musicbrainz_artist.get('type'),
+    }
+
+
+def _index_by_name(musicbrainz_artists: Iterable[Dict]) -> Dict[str, Dict]:
+    # Results come back ordered by score, so the first artist seen for a name wins
+    index = {}
+    for musicbrainz_artist in musicbrainz_artists:
+        names = [musicbrainz_artist.get('name', '')]
+        names += [alias.get('name', '') for alias in musicbrainz_artist.get('aliases') or []]
+        for name in names:
+            if name:
+                index.setdefault(normalize_artist_name(name), _attributes(musicbrainz_artist))
+    return index
+
+
+def _lookup_batch(names: List[str]):
+    """The batch's matches by name, and whether MusicBrainz returned every artist it found."""
+    response = get_artist_info(names)
+    musicbrainz_artists = response.get('artists', [])
+    complete = response.get('count', len(musicbrainz_artists)) <= len(musicbrainz_artists)
+    return _index_by_name(musicbrainz_artists), complete
+
+
+def _lookup_names(names: List[str]) -> Tuple[Dict[str, Optional[Dict]], Set[str]]:
+    """
+    MusicBrainz attributes for normalized names, None for a name MusicBrainz does not know,
+    plus the names it could not settle. Common names can push an exact match out of a
+    batch's truncated results, so names missing from one are asked for on their own; a name
+    still missing from truncated results is unsettled: unknown for now, but worth retrying.
+    """
+    batches = chunked(names, MUSICBRAINZ_BATCH_SIZE)
+    results = bounded_map(_lookup_batch, batches, pool='musicbrainz')
+    index = {}
+    for batch_index, _ in results:
+        for name, attributes in batch_index.items():
+            index.setdefault(name, attributes)
+
+    looked_up, retry = {}, []
+    for batch, (_, complete) in zip(batches, results):
+        for name in batch:
+            if name in index or complete:
+                looked_up[name] = index.get(name)
+            else:
+                retry.append(name)
+    unsettled = set()
+    for name, (batch_index, complete) in zip(retry, bounded_map(_lookup_batch, [[name] for name in retry],
+                                                                pool='musicbrainz')):
+        looked_up[name] = batch_index.get(name)
+        if name not in batch_index and not complete:
+            unsettled.add(name)
+    return looked_up, unsettled
+
+
+def get_artist_attributes(artists: Iterable[Dict]) -> Dict[str, Optional[Dict]]:
+    """
+    Map Spotify artist objects (with id and name) to their MusicBrainz gender/type attributes,
+    looking up only artists that are in neither the ID nor the name cache.
+    """
+    artists_by_id = {artist['id']: artist for artist in artists}
+    attributes = {}
+    for cache_key, value in artist_attribute_cache.get_many(f"spotify:{artist_id}" for artist_id in artists_by_id).items():
+        attributes[cache_key[len("spotify:"):]] = value
+
+    unresolved = [artist for artist_id, artist in artists_by_id.items() if artist_id not in attributes]
+    names = list(dict.fromkeys(normalize_artist_name(artist['name']) for artist in unresolved))
+    by_name = {cache_key[len("name:"):]: value
+               for cache_key, value in artist_attribute_cache.get_many(f"name:{name}" for name in names).items()}
+
+    missing_names = [name for name in names if name not in by_name]
+    unsettled = set()
+    if missing_names:
+        looked_up, unsettled = _lookup_names(missing_names)
+        artist_attribute_cache.set_many({f"name:{name}": value for name, value in looked_up.items()
+                                         if name not in unsettled})
+        artist_attribute_cache.set_many({f"name:{name}": None for name in unsettled},
+                                        ttl=ARTIST_ATTRIBUTE_UNSETTLED_TTL)
+        by_name.update(looked_up)
+
+    resolved = {artist['id']: by_name.get(normalize_artist_name(artist['name'])) for artist in unresolved}
+    unsettled_ids = {artist['id'] for artist in unresolved if normalize_artist_name(artist['name']) in unsettled}
+    artist_attribute_cache.set_many({f"spotify:{artist_id}": value for artist_id, value in resolved.items()
+                                     if artist_id not in unsettled_ids})
+    artist_attribute_cache.set_many({f"spotify:{artist_id}": None for artist_id in unsettled_ids},
+                                    ttl=ARTIST_ATTRIBUTE_UNSETTLED_TTL)
+    attributes.update(resolved)
+    return attributes
+
+
+def filter_songs_by_gender(songs: List[Dict], gender: str) -> List[Dict]:
+    """Keep the songs whose primary artist MusicBrainz lists with the given gender."""
+    primary_artists = [song['artists'][0] for song in songs if song.get('artists')]
+    attributes = get_artist_attributes(primary_artists)
+    gender = gender.casefold()
+    return [
+        song for song in songs
+        if song.get('artists') and (attributes.get(song['artists'][0]['id']) or {}).get('gender') == gender
+    ]
@@ -0,0 +1,184 @@
+import bisect
+import heapq
+import os
+import re
+import threading
+import unicodedata
+from typing import Dict, Iterable, List, Optional
+
+from .cache import CACHE_DB_PATH
+from .sqlite import SqliteConnections
+
+# Queries this short match a large share of the index, so their best matches are kept ranked
+SHORT_PREFIX_LENGTH = 2
+SHORT_PREFIX_TOP = int(os.environ.get('ARTIST_INDEX_SHORT_PREFIX_TOP', 50))
+# Smaller batches of new keys are inserted in place; larger ones are appended and sorted once
+INSORT_LIMIT = 500
+
+_NON_WORD = re.compile(r'[^\w]+')
+
+
+def normalize_query(text: str) -> str:
+    """Casefolded, accent-free, punctuation-free form used for every key and query."""
+    text = text or ''
+    if not text.isascii():
+        decomposed = unicodedata.normalize('NFKD', text)
+        text = ''.join(character for character in decomposed if not unicodedata.combining(character))
+    return ' '.join(_NON_WORD.sub(' ', text.casefold()).split())
+
+
+def _name_keys(name: str) -> List[str]:
+    # The whole name and every suffix starting at a word, so "weeknd" finds "The Weeknd"
+    tokens = normalize_query(name).split()
+    return [' '.join(tokens[index:]) for index in range(len(tokens))]
+
+
+class ArtistIndex:
+    """
+    Every artist the service has seen, searchable by normalized prefix of the name or of any
+    word in it, best-known first. Keys live in one sorted list, so a lookup is a binary
+    search plus a scan of the matching run; for one- and two-character queries, whose runs
+    span much of the index, the best SHORT_PREFIX_TOP matches are kept ranked instead.
+    Artists are persisted to SQLite and reloaded on first use.
+    """
+
+    def __init__(self, path: Optional[str] = CACHE_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._artists: Dict[str, Dict] = {}
+        self._keys: List[tuple] = []
+        self._top: Dict[str, List[str]] = {}
+        self._connection = SqliteConnections(path, [
+            "CREATE TABLE IF NOT EXISTS artist_index"
+            " (id TEXT PRIMARY KEY, name TEXT, image_url TEXT, popularity INTEGER)"
+        ]) if path is not None else None
+
+    def _rank(self, artist_id: str) -> tuple:
+        artist = self._artists[artist_id]
+        return -(artist['popularity'] or 0), len(artist['name']), artist_id
+
+    def _insert(self, artist: Dict, new_keys: List[tuple]) -> bool:
+        """
+        Add or enrich one artist, collecting its keys in new_keys for _merge; returns whether
+        anything changed. Caller holds the lock.
+        """
+        existing = self._artists.get(artist['id'])
+        if existing is None:
+            self._artists[artist['id']] = artist
+            new_keys.extend((key, artist['id']) for key in _name_keys(artist['name']))
+            return True
+        changed = False
+        for field in ('image_url', 'popularity'):
+            if artist.get(field) is not None and artist[field] != existing.get(field):
+                existing[field] = artist[field]
+                changed = True
+        return changed
+
+    def _short_prefixes(self, artist_id: str) -> set:
+        return {key[:length] for key in _name_keys(self._artists[artist_id]['name'])
+                for length in range(1, min(len(key), SHORT_PREFIX_LENGTH) + 1)}
+
+    def _scan(self, prefix: str) -> List[str]:
+        index = bisect.bisect_left(self._keys, (prefix,))
+        matches = set()
+        while index < len(self._keys) and self._keys[index][0].startswith(prefix):
+            matches.add(self._keys[index][1])
+            index += 1
+        return list(matches)
+
+    def _merge(self, new_keys: List[tuple], changed_ids: Iterable[str]):
+        """Fold a batch of inserts into the sorted keys and the short-prefix rankings. Caller holds the lock."""
+        if len(new_keys) <= INSORT_LIMIT:
+            for key in new_keys:
+                bisect.insort(self._keys, key)
+        else:
+            self._keys.extend(new_keys)
+            self._keys.sort()
+        candidates: Dict[str, set] = {}
+        rescan = set()
+        for artist_id in changed_ids:
+            for prefix in self._short_prefixes(artist_id):
+                top = self._top.get(prefix, [])
+                if len(top) >= SHORT_PREFIX_TOP and artist_id in top:
+                    # A ranked artist may have dropped below one that is not kept
+                    rescan.add(prefix)
+                candidates.setdefault(prefix, set(top)).add(artist_id)
+        for prefix, artist_ids in candidates.items():
+            if prefix in rescan:
+                artist_ids = self._scan(prefix)
+            self._top[prefix] = sorted(artist_ids, key=self._rank)[:SHORT_PREFIX_TOP]
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            if self._connection is not None:
+                rows = self._connection().execute("SELECT id, name, image_url, popularity FROM artist_index").fetchall()
+                new_keys = []
+                for artist_id, name, image_url, popularity in rows:
+                    self._insert({"id": artist_id, "name": name, "image_url": image_url, "popularity": popularity},
+                                 new_keys)
+                self._keys = sorted(new_keys)
+                by_prefix: Dict[str, set] = {}
+                for key, artist_id in self._keys:
+                    for length in range(1, min(len(key), SHORT_PREFIX_LENGTH) + 1):
+                        by_prefix.setdefault(key[:length], set()).add(artist_id)
+                position = {artist_id: index for index, artist_id in enumerate(sorted(self._artists, key=self._rank))}
+                self._top = {prefix: heapq.nsmallest(SHORT_PREFIX_TOP, artist_ids, key=position.__getitem__)
+                             for prefix, artist_ids in by_prefix.items()}
+            self._loaded = True
+
+    def __len__(self) -> int:
+        self._ensure_loaded()
+        return len(self._artists)
+
+    def add(self, artists: Iterable[Dict]):
+        """Index artists given as {id, name, image_url?, popularity?}; known ones keep their best data."""
+        self._ensure_loaded()
+        with self._lock:
+            new_keys = []
+            changed = [dict(self._artists[artist['id']]) for artist in artists
+                       if artist and artist.get('id') and artist.get('name')
+                       and self._insert({"id": artist['id'], "name": artist['name'],
+                                         "image_url": artist.get('image_url'),
+                                         "popularity": artist.get('popularity')}, new_keys)]
+            self._merge(new_keys, [artist['id'] for artist in changed])
+        if changed and self._connection is not None:
+            self._connection().executemany(
+                "INSERT OR REPLACE INTO artist_index (id, name, image_url, popularity) VALUES (?, ?, ?, ?)",
+                [(artist['id'], artist['name'], artist['image_url'], artist['popularity']) for artist in changed])
+
+    def add_from_tracks(self, tracks: Iterable[Dict]):
+        # Track payloads carry no artist popularity; the track's own stands in until a search supplies it
+        artists = {}
+        for track in tracks:
+            for artist in (track or {}).get('artists') or []:
+                if artist.get('id') and artist.get('name'):
+                    known = artists.get(artist['id'])
+                    popularity = track.get('popularity')
+                    if known is None or (popularity or 0) > (known['popularity'] or 0):
+                        artists[artist['id']] = {"id": artist['id'], "name": artist['name'], "popularity": popularity}
+        with self._lock:
+            # Never let a track's popularity replace one that came from an artist search
+            fresh = [artist for artist_id, artist in artists.items() if artist_id not in self._artists]
+        self.add(fresh)
+
+    def search(self, query: str, limit: int = 10) -> List[Dict]:
+        """Up to limit artists with a name or name word starting with query, most popular first."""
+        self._ensure_loaded()
+        prefix = normalize_query(query)
+        if not prefix:
+            return []
+        with self._lock:
+            if len(prefix) <= SHORT_PREFIX_LENGTH and limit <= SHORT_PREFIX_TOP:
+                ranked = self._top.get(prefix, [])[:limit]
+            else:
+                ranked = sorted(self._scan(prefix), key=self._rank)[:limit]
+            return [{"id": artist_id, "name": self._artists[artist_id]['name'],
+                     "image_url": self._artists[artist_id]['image_url']} for artist_id in ranked]
+
+
+artist_index = ArtistIndex(os.environ.get('ARTIST_INDEX_PATH', CACHE_DB_PATH))
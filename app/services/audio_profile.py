@@ -0,0 +1,100 @@
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from .feature_store import FEATURE_COLUMNS
+
+# Natural range of each column, used to put every feature on a 0-1 scale before measuring distance
+FEATURE_RANGES = {
+    'acousticness': (0.0, 1.0),
+    'danceability': (0.0, 1.0),
+    'duration_ms': (0.0, 600000.0),
+    'energy': (0.0, 1.0),
+    'instrumentalness': (0.0, 1.0),
+    'key': (0.0, 11.0),
+    'liveness': (0.0, 1.0),
+    'loudness': (-60.0, 0.0),
+    'mode': (0.0, 1.0),
+    'speechiness': (0.0, 1.0),
+    'tempo': (0.0, 250.0),
+    'time_signature': (3.0, 7.0),
+    'valence': (0.0, 1.0),
+}
+_RANGE_LOW = np.array([FEATURE_RANGES[column][0] for column in FEATURE_COLUMNS])
+_RANGE_SPAN = np.array([FEATURE_RANGES[column][1] - FEATURE_RANGES[column][0] for column in FEATURE_COLUMNS])
+
+
+def _to_float(value) -> float:
+    if value is None or isinstance(value, str):
+        return np.nan
+    return float(value)
+
+
+def profile_vector(profile: Dict) -> np.ndarray:
+    """A feature dict as a row in FEATURE_COLUMNS order, NaN where a feature is absent."""
+    return np.array([_to_float(profile.get(column)) for column in FEATURE_COLUMNS])
+
+
+def vector_to_profile(vector: np.ndarray, columns: Optional[Sequence[str]] = None) -> Dict[str, float]:
+    wanted = set(columns or FEATURE_COLUMNS)
+    return {column: float(value) for column, value in zip(FEATURE_COLUMNS, vector)
+            if column in wanted and not np.isnan(value)}
+
+
+def normalize(values: np.ndarray) -> np.ndarray:
+    return (values - _RANGE_LOW) / _RANGE_SPAN
+
+
+class FeatureMatrix:
+    """
+    Dense float matrix of audio features, one row per track and one column per FEATURE_COLUMNS
+    entry. Missing values are NaN and are left out of every aggregate and comparison.
+    """
+
+    def __init__(self, ids: List[str], values: np.ndarray):
+        self.ids = ids
+        self.values = values.reshape(len(ids), len(FEATURE_COLUMNS))
+
+    @classmethod
+    def from_features(cls, features_list: Iterable[Optional[Dict]]) -> 'FeatureMatrix':
+        rows = [features for features in features_list if features]
+        ids = [features.get('id') for features in rows]
+        values = np.array([profile_vector(features) for features in rows], dtype=np.float64)
+        return cls(ids, values)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def mask(self) -> np.ndarray:
+        return ~np.isnan(self.values)
+
+    def mean(self) -> np.ndarray:
+        return self.weighted_centroid(None)
+
+    def weighted_centroid(self, weights: Optional[Sequence[float]]) -> np.ndarray:
+        weights = np.ones(len(self)) if weights is None else np.asarray(weights, dtype=np.float64)
+        mask = self.mask
+        column_weights = (mask * weights[:, None]).sum(axis=0)
+        totals = (np.where(mask, self.values, 0.0) * weights[:, None]).sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(column_weights > 0, totals / column_weights, np.nan)
+
+    def within_tolerance(self, target: np.ndarray, tolerance: float) -> np.ndarray:
+        """Rows whose every feature present in target lies within tolerance * |target| of it."""
+        compared = ~np.isnan(target)
+        low = np.minimum((1 - tolerance) * target, (1 + tolerance) * target)
+        high = np.maximum((1 - tolerance) * target, (1 + tolerance) * target)
+        with np.errstate(invalid='ignore'):
+            inside = (self.values >= low) & (self.values <= high)
+        return np.all(inside | ~compared, axis=1)
+
+    def distances(self, target: np.ndarray) -> np.ndarray:
+        """Euclidean distance to target in the normalized space, over the features both have."""
+        difference = normalize(self.values) - normalize(target)
+        present = ~np.isnan(difference)
+        squared = np.where(present, difference ** 2, 0.0).sum(axis=1)
+        counts = present.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # Scale by the share of features compared so sparse rows are not favoured
+            return np.where(counts > 0, np.sqrt(squared * len(FEATURE_COLUMNS) / counts), np.inf)
@@ -0,0 +1,207 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+
+from .sqlite import SqliteConnections
+
+CACHE_DB_PATH = os.environ.get('CACHE_DB_PATH', 'cache.sqlite3')
+# Rows kept per cache in the SQLite tier; the sweep drops those closest to expiry beyond it
+CACHE_MAX_DISK_ENTRIES = int(os.environ.get('CACHE_MAX_DISK_ENTRIES', 200000))
+
+MISSING = object()
+
+_caches: List['TieredCache'] = []
+
+
+class _SqliteTier:
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = SqliteConnections(path, [
+            "CREATE TABLE IF NOT EXISTS cache_entries ("
+            " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT, expires_at REAL,"
+            " PRIMARY KEY (namespace, key))",
+            "CREATE INDEX IF NOT EXISTS cache_entries_expires_at ON cache_entries (namespace, expires_at)"])
+
+    def get(self, namespace: str, key: str):
+        row = self._connection().execute(
+            "SELECT value, expires_at FROM cache_entries WHERE namespace = ? AND key = ?",
+            (namespace, key)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1]
+
+    def set_many(self, namespace: str, rows: Iterable[tuple]):
+        self._connection().executemany(
+            "INSERT OR REPLACE INTO cache_entries (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            [(namespace, key, value, expires_at) for key, value, expires_at in rows])
+
+    def delete(self, namespace: str, key: str):
+        self._connection().execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def purge_expired(self, namespace: str):
+        self._connection().execute(
+            "DELETE FROM cache_entries WHERE namespace = ? AND expires_at IS NOT NULL AND expires_at < ?",
+            (namespace, time.time()))
+
+    def trim(self, namespace: str, max_rows: int):
+        connection = self._connection()
+        excess = connection.execute("SELECT COUNT(*) FROM cache_entries WHERE namespace = ?",
+                                    (namespace,)).fetchone()[0] - max_rows
+        if excess > 0:
+            # No access times are kept, so the entries closest to expiring go first
+            connection.execute(
+                "DELETE FROM cache_entries WHERE namespace = ? AND key IN (SELECT key FROM cache_entries"
+                " WHERE namespace = ? ORDER BY expires_at IS NULL, expires_at LIMIT ?)",
+                (namespace, namespace, excess))
+
+
+_sqlite_tiers: Dict[str, _SqliteTier] = {}
+_sqlite_lock = threading.Lock()
+
+
+def _sqlite_tier(path: str) -> _SqliteTier:
+    with _sqlite_lock:
+        tier = _sqlite_tiers.get(path)
+        if tier is None:
+            tier = _SqliteTier(path)
+            _sqlite_tiers[path] = tier
+        return tier
+
+
+class TieredCache:
+    """
+    Two-tier cache: an in-process LRU in front of an optional SQLite table shared by all
+    caches on the same file. A stored value of None is a negative entry and uses negative_ttl.
+    get() returns MISSING when nothing usable is cached.
+    """
+
+    def __init__(self, name: str, max_entries: int = 10000, ttl: Optional[float] = None,
+                 negative_ttl: Optional[float] = None, persistent: bool = True, path: str = CACHE_DB_PATH,
+                 max_disk_entries: int = CACHE_MAX_DISK_ENTRIES):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl if negative_ttl is not None else ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = _sqlite_tier(path) if persistent else None
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        _caches.append(self)
+
+    def _expiry(self, value) -> Optional[float]:
+        ttl = self.negative_ttl if value is None else self.ttl
+        return time.time() + ttl if ttl is not None else None
+
+    def _remember(self, key: str, value, expires_at: Optional[float]):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _count(self, value):
+        with self._lock:
+            if value is MISSING:
+                self.misses += 1
+            elif value is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+
+    def _lookup(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] is None or entry[1] > now:
+                    self._entries.move_to_end(key)
+                    return entry[0]
+                del self._entries[key]
+
+        if self._disk is None:
+            return MISSING
+        row = self._disk.get(self.name, key)
+        if row is None:
+            return MISSING
+        raw, expires_at = row
+        if expires_at is not None and expires_at <= now:
+            self._disk.delete(self.name, key)
+            return MISSING
+        value = json.loads(raw)
+        self._remember(key, value, expires_at)
+        return value
+
+    def get(self, key: str) -> Any:
+        value = self._lookup(key)
+        self._count(value)
+        return value
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Return the cached value for every key that has one; misses are left out."""
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not MISSING:
+                found[key] = value
+        return found
+
+    def set(self, key: str, value, ttl: Optional[float] = None):
+        self.set_many({key: value}, ttl=ttl)
+
+    def set_many(self, items: Dict[str, Any], ttl: Optional[float] = None):
+        """Store items for ttl seconds, or for the cache's ttl (negative_ttl for None) when not given."""
+        rows = []
+        for key, value in items.items():
+            expires_at = time.time() + ttl if ttl is not None else self._expiry(value)
+            self._remember(key, value, expires_at)
+            rows.append((key, json.dumps(value, separators=(',', ':')), expires_at))
+        if self._disk is not None and rows:
+            self._disk.set_many(self.name, rows)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self._disk is not None:
+            self._disk.delete(self.name, key)
+
+    def purge_expired(self):
+        """Drop expired entries from both tiers and trim the SQLite tier to max_disk_entries."""
+        now = time.time()
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[1] is not None and entry[1] <= now]:
+                del self._entries[key]
+        if self._disk is not None:
+            self._disk.purge_expired(self.name)
+            self._disk.trim(self.name, self.max_disk_entries)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'hit_ratio': (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+            }
+
+
+def all_cache_stats() -> Dict[str, Dict[str, float]]:
+    return {cache.name: cache.stats() for cache in _caches}
+
+
+def sweep_caches(interval: float):
+    """Purge every cache each interval seconds; run on a daemon thread."""
+    while True:
+        time.sleep(interval)
+        for cache in list(_caches):
+            try:
+                cache.purge_expired()
+            except Exception as error:
+                print(f"Error sweeping the {cache.name} cache:", error)
@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Set
+
+import numpy as np
+
+from .audio_profile import FeatureMatrix, profile_vector
+from .cache import CACHE_DB_PATH
+from .feature_store import FEATURE_COLUMNS
+from .sqlite import SqliteConnections
+from .tracks import compact_track
+
+
+class CandidateIndex:
+    """
+    Every track the service has seen together with its audio features, searchable by distance
+    to a target profile. Rows live in one contiguous float matrix that grows by doubling, and a
+    query is a single vectorized scan over the normalized feature space, which is exact and
+    fast enough for the tens of thousands of tracks one deployment sees. Rows are persisted to
+    SQLite and reloaded on first use.
+    """
+
+    def __init__(self, path: Optional[str] = CACHE_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._ids: List[str] = []
+        self._positions: Dict[str, int] = {}
+        self._tracks: List[Dict] = []
+        self._values = np.empty((0, len(FEATURE_COLUMNS)))
+        self._connection = SqliteConnections(path, [
+            "CREATE TABLE IF NOT EXISTS candidate_tracks (id TEXT PRIMARY KEY, track TEXT, features TEXT)"
+        ]) if path is not None else None
+
+    def _append(self, rows: List[tuple]):
+        needed = len(self._ids) + len(rows)
+        if needed > len(self._values):
+            grown = np.empty((max(needed, 2 * len(self._values), 1024), len(FEATURE_COLUMNS)))
+            grown[:len(self._ids)] = self._values[:len(self._ids)]
+            self._values = grown
+        for track_id, track, vector in rows:
+            self._positions[track_id] = len(self._ids)
+            self._values[len(self._ids)] = vector
+            self._ids.append(track_id)
+            self._tracks.append(track)
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            if self._connection is not None:
+                rows = self._connection().execute("SELECT id, track, features FROM candidate_tracks").fetchall()
+                self._append([(track_id, json.loads(track), np.array(json.loads(features), dtype=np.float64))
+                              for track_id, track, features in rows])
+            self._loaded = True
+
+    def __len__(self) -> int:
+        self._ensure_loaded()
+        return len(self._ids)
+
+    def add(self, tracks: Iterable[Dict], audio_features: Iterable[Dict]):
+        """Index the tracks that have audio features and are not indexed yet."""
+        self._ensure_loaded()
+        features_by_id = {features['id']: features for features in audio_features if features}
+        with self._lock:
+            rows = []
+            for track in tracks:
+                track_id = track.get('id') if track else None
+                if track_id in features_by_id and track_id not in self._positions:
+                    rows.append((track_id, compact_track(track), profile_vector(features_by_id[track_id])))
+            if not rows:
+                return
+            self._append(rows)
+        if self._connection is not None:
+            self._connection().executemany(
+                "INSERT OR IGNORE INTO candidate_tracks (id, track, features) VALUES (?, ?, ?)",
+                [(track_id, json.dumps(track, separators=(',', ':')),
+                  json.dumps([None if np.isnan(value) else float(value) for value in vector]))
+                 for track_id, track, vector in rows])
+
+    def nearest(self, target: Dict, limit: int, exclude_ids: Optional[Set[str]] = None,
+                max_distance: Optional[float] = None) -> List[Dict]:
+        """Up to limit indexed tracks closest to the target profile, nearest first."""
+        self._ensure_loaded()
+        with self._lock:
+            count = len(self._ids)
+            matrix = FeatureMatrix(self._ids[:count], self._values[:count])
+            tracks = self._tracks[:count]
+        if not count:
+            return []
+
+        distances = matrix.distances(profile_vector(target))
+        candidates = np.argsort(distances, kind='stable')
+        exclude_ids = exclude_ids or set()
+        nearest = []
+        for index in candidates:
+            if max_distance is not None and distances[index] > max_distance:
+                break
+            if matrix.ids[index] in exclude_ids:
+                continue
+            nearest.append(tracks[index])
+            if len(nearest) >= limit:
+                break
+        return nearest
+
+
+candidate_index = CandidateIndex(os.environ.get('CANDIDATE_INDEX_PATH', CACHE_DB_PATH))
@@ -0,0 +1,105 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, Iterable, List, Optional
+
+from flask import copy_current_request_context, has_request_context
+
+MAX_WORKERS = int(os.environ.get('SPOTIFY_MAX_WORKERS', 16))
+PER_USER_CONCURRENCY = int(os.environ.get('SPOTIFY_PER_USER_CONCURRENCY', 4))
+
+_executors: Dict[str, ThreadPoolExecutor] = {}
+_user_slots: Dict[str, list] = {}
+_lock = threading.Lock()
+
+
+def get_executor(name: str = 'default', max_workers: int = MAX_WORKERS) -> ThreadPoolExecutor:
+    # One pool per stage, so a stage waiting on another never starves it of threads
+    with _lock:
+        executor = _executors.get(name)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'sp-{name}')
+            _executors[name] = executor
+        return executor
+
+
+def _acquire_user_slot(user_key: str) -> threading.BoundedSemaphore:
+    with _lock:
+        slot = _user_slots.get(user_key)
+        if slot is None:
+            slot = [threading.BoundedSemaphore(PER_USER_CONCURRENCY), 0]
+            _user_slots[user_key] = slot
+        slot[1] += 1
+    slot[0].acquire()
+    return slot[0]
+
+
+def _release_user_slot(user_key: str):
+    with _lock:
+        slot = _user_slots[user_key]
+        slot[0].release()
+        slot[1] -= 1
+        if slot[1] == 0:
+            del _user_slots[user_key]
+
+
+def chunked(items: List, size: int) -> List[List]:
+    return [items[index:index + size] for index in range(0, len(items), size)]
+
+
+def submit_bounded(fn: Callable, *args, user_key: Optional[str] = None, pool: str = 'default') -> Future:
+    """
+    Submit fn(*args) to a shared worker pool, carrying over the current request context.
+    Blocks the caller while user_key already has PER_USER_CONCURRENCY calls in flight.
+    """
+    call = partial(fn, *args)
+    if has_request_context():
+        call = copy_current_request_context(call)
+    executor = get_executor(pool)
+    if user_key is None:
+        return executor.submit(call)
+    _acquire_user_slot(user_key)
+    try:
+        future = executor.submit(call)
+    except Exception:
+        _release_user_slot(user_key)
+        raise
+    future.add_done_callback(lambda _: _release_user_slot(user_key))
+    return future
+
+
+def bounded_map(fn: Callable, items: Iterable, user_key: Optional[str] = None, pool: str = 'default') -> List:
+    """Run fn over items with submit_bounded and return the results in order."""
+    futures = [submit_bounded(fn, item, user_key=user_key, pool=pool) for item in items]
+    return [future.result() for future in futures]
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls for the same key into one: the first caller runs fn and every
+    caller that arrives while it is in flight gets the same result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+
+    def do(self, key: str, fn: Callable):
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(fn())
+        except BaseException as error:
+            future.set_exception(error)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return future.result()
@@ -0,0 +1,49 @@
+import os
+from typing import Callable, Dict, List, Optional
+
+from .cache import TieredCache
+from .concurrency import bounded_map, chunked
+
+FEATURE_COLUMNS = ('acousticness', 'danceability', 'duration_ms', 'energy', 'instrumentalness', 'key', 'liveness',
+                   'loudness', 'mode', 'speechiness', 'tempo', 'time_signature', 'valence')
+AUDIO_FEATURES_BATCH_SIZE = 100
+
+# Audio features never change for a track, so positive entries do not expire
+feature_cache = TieredCache('audio_features',
+                            max_entries=int(os.environ.get('FEATURE_CACHE_SIZE', 100000)),
+                            ttl=None,
+                            negative_ttl=float(os.environ.get('FEATURE_CACHE_NEGATIVE_TTL', 24 * 3600)))
+
+
+def pack_features(features: Dict) -> List[Optional[float]]:
+    return [features.get(column) for column in FEATURE_COLUMNS]
+
+
+def unpack_features(track_id: str, packed: List[Optional[float]]) -> Dict:
+    features = dict(zip(FEATURE_COLUMNS, packed))
+    features['id'] = track_id
+    return features
+
+
+def get_features(track_ids: List[str], fetch_batch: Callable[[List[str]], List[Optional[Dict]]],
+                 user_key: Optional[str] = None) -> List[Dict]:
+    """
+    Audio features for track_ids in order, skipping tracks Spotify has none for.
+    Only IDs missing from the cache are fetched, in upstream-sized batches run in parallel.
+    """
+    unique_ids = list(dict.fromkeys(track_id for track_id in track_ids if track_id))
+    known = feature_cache.get_many(unique_ids)
+    missing = [track_id for track_id in unique_ids if track_id not in known]
+
+    if missing:
+        batches = bounded_map(fetch_batch, chunked(missing, AUDIO_FEATURES_BATCH_SIZE),
+                              user_key=user_key, pool='features')
+        fetched = {track_id: None for track_id in missing}
+        for batch in batches:
+            for features in batch:
+                if features:
+                    fetched[features['id']] = pack_features(features)
+        feature_cache.set_many(fetched)
+        known.update(fetched)
+
+    return [unpack_features(track_id, known[track_id]) for track_id in unique_ids if known.get(track_id)]
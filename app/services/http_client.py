@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Optional
+
+from .metrics import observe_upstream, upstream_retries_total
+from .scheduler import NORMAL, backoff_delay, parse_retry_after, upstream_scheduler
+
+if TYPE_CHECKING:
+    import requests
+
+DEFAULT_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 20))
+DEFAULT_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+DEFAULT_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 15))
+DEFAULT_RETRIES = int(os.environ.get('HTTP_RATE_LIMIT_RETRIES', 3))
+# A longer Retry-After (Spotify sends hours) is not waited out: the response goes back to the caller at once
+MAX_RETRY_AFTER = float(os.environ.get('HTTP_MAX_RETRY_AFTER', 30))
+
+RETRYABLE_STATUSES = {502, 503, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+
+class PooledClient:
+    """
+    Keep-alive HTTP client for a single upstream, implementing the RequestClient interface.
+    Connections are pooled on one requests.Session and reused across threads, and every
+    call is admitted by the shared upstream scheduler when rate limits are configured.
+    """
+
+    def __init__(self, name: str, base_url: str, pool_size: int = DEFAULT_POOL_SIZE,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT, read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 default_headers: Optional[Dict[str, str]] = None, rate: Optional[float] = None,
+                 burst: Optional[float] = None, per_key_rate: Optional[float] = None,
+                 per_key_burst: Optional[float] = None):
+        self.name = name
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.default_headers = default_headers
+        self._session = None
+        self._session_lock = threading.Lock()
+        self.scheduled = bool(rate)
+        if rate:
+            upstream_scheduler.configure(name, rate, burst or rate, per_key_rate, per_key_burst)
+
+    @property
+    def session(self) -> 'requests.Session':
+        # Built on first use, so importing a module that declares a client costs nothing
+        if self._session is not None:
+            return self._session
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        with self._session_lock:
+            if self._session is not None:
+                return self._session
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({'Connection': 'keep-alive'})
+            if self.default_headers:
+                session.headers.update(self.default_headers)
+            self._session = session
+        return self._session
+
+    def _send(self, method: str, endpoint: str, priority: int, **kwargs) -> 'requests.Response':
+        headers = kwargs.get('headers') or {}
+        upstream_scheduler.acquire(self.name, key=headers.get('Authorization'), priority=priority)
+        kwargs.setdefault('timeout', self.timeout)
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            response = self.session.request(method, self.base_url + endpoint, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            observe_upstream(self.name, endpoint, status, time.perf_counter() - started)
+
+    def request(self, method: str, endpoint: str, priority: int = NORMAL, retries: int = DEFAULT_RETRIES,
+                **kwargs) -> 'requests.Response':
+        """
+        Send a request, retrying 429s (and 5xx overload responses for idempotent methods)
+        after Retry-After or a jittered exponential backoff. The last response is returned as is,
+        as is one asking for a wait longer than MAX_RETRY_AFTER.
+        """
+        attempt = 0
+        while True:
+            response = self._send(method, endpoint, priority, **kwargs)
+            retryable = response.status_code == 429 or (
+                response.status_code in RETRYABLE_STATUSES and method.upper() in IDEMPOTENT_METHODS)
+            if not retryable or attempt >= retries:
+                return response
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None and retry_after > MAX_RETRY_AFTER:
+                return response
+            upstream_retries_total.inc(self.name, response.status_code)
+
+            if retry_after is not None and self.scheduled:
+                # Everyone calling this upstream waits it out, not just this caller
+                upstream_scheduler.penalize(self.name, retry_after)
+                time.sleep(backoff_delay(0) * 0.2)
+            elif retry_after is not None:
+                time.sleep(retry_after + backoff_delay(0) * 0.2)
+            else:
+                time.sleep(backoff_delay(attempt))
+            attempt += 1
+
+    def make_request(self, endpoint: str, headers: Dict[str, str], method: str = "GET", params: Optional[Dict] = None,
+                     json: Optional[Dict] = None, retries: int = DEFAULT_RETRIES, priority: int = NORMAL) -> Dict:
+        response = self.request(method, endpoint, priority=priority, retries=retries, headers=headers,
+                                params=params, json=json)
+        response.raise_for_status()
+        return response.json()
+
+    def connect(self):
+        """
+        Open a pooled connection to the upstream (DNS, TCP and TLS) ahead of the first real
+        call. The HEAD request bypasses the scheduler and its status is irrelevant.
+        """
+        self.session.head(self.base_url, timeout=self.timeout, allow_redirects=False)
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
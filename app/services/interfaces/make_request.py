@@ -1,5 +1,7 @@
-from typing import Dict, Optional
+from typing import Dict, Optional, Protocol
 
 
-def make_request(endpoint: str, headers: Dict[str, str], method: str = "GET", params: Optional[Dict] = None, json: Optional[Dict] = None, retries: int = 1) -> Dict:
-    pass
\ No newline at end of file
+class RequestClient(Protocol):
+    def make_request(self, endpoint: str, headers: Dict[str, str], method: str = "GET", params: Optional[Dict] = None,
+                     json: Optional[Dict] = None, retries: int = 1) -> Dict:
+        ...
@@ -0,0 +1,186 @@
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from .cache import CACHE_DB_PATH
+from .pipeline import GenerationCancelled
+from .sqlite import SqliteConnections
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOB_TIMEOUT = float(os.environ.get('JOB_TIMEOUT', 120))
+JOB_RETENTION = float(os.environ.get('JOB_RETENTION', 3600))
+# Shared by every worker process on the host, so any of them can report on or cancel a job
+JOB_DB_PATH = os.environ.get('JOB_DB_PATH', CACHE_DB_PATH)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+TIMED_OUT = 'timed_out'
+FINISHED_STATUSES = {SUCCEEDED, FAILED, CANCELLED, TIMED_OUT}
+
+_COLUMNS = ('id', 'owner', 'status', 'stage', 'partial', 'result', 'error', 'created_at', 'started_at',
+            'finished_at', 'deadline')
+_JSON_COLUMNS = {'partial', 'result'}
+_UNFINISHED = f"status NOT IN ({', '.join(repr(status) for status in sorted(FINISHED_STATUSES))})"
+
+
+class JobStore:
+    """Job records in a SQLite table; the work itself runs on whichever process accepted the job."""
+
+    def __init__(self, path: str):
+        self._connection = SqliteConnections(path, [
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, owner TEXT, status TEXT NOT NULL, stage TEXT,"
+            " partial TEXT, result TEXT, error TEXT, created_at REAL NOT NULL, started_at REAL, finished_at REAL,"
+            " deadline REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at)"])
+
+    @staticmethod
+    def _encode(column: str, value):
+        return json.dumps(value, separators=(',', ':')) if column in _JSON_COLUMNS and value is not None else value
+
+    def insert(self, record: Dict):
+        self._connection().execute(
+            f"INSERT INTO jobs ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' for _ in _COLUMNS)})",
+            [self._encode(column, record.get(column)) for column in _COLUMNS])
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        row = self._connection().execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE id = ?",
+                                         (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {column: json.loads(value) if column in _JSON_COLUMNS and value is not None else value
+                for column, value in zip(_COLUMNS, row)}
+
+    def update(self, job_id: str, unfinished_only: bool = True, **fields) -> bool:
+        """Set fields on the job; with unfinished_only, only while it has not finished. Returns whether it did."""
+        assignments = ', '.join(f"{column} = ?" for column in fields)
+        condition = f" AND {_UNFINISHED}" if unfinished_only else ""
+        cursor = self._connection().execute(
+            f"UPDATE jobs SET {assignments} WHERE id = ?{condition}",
+            [self._encode(column, value) for column, value in fields.items()] + [job_id])
+        return cursor.rowcount > 0
+
+    def status(self, job_id: str) -> Optional[str]:
+        row = self._connection().execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def purge_finished(self, before: float):
+        self._connection().execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (before,))
+
+
+class Job:
+    """A job running in this process; its state lives in the store, where other workers see it."""
+
+    def __init__(self, store: JobStore, job_id: str, deadline: float):
+        self.store = store
+        self.id = job_id
+        self.deadline = deadline
+        self.cancel_event = threading.Event()
+
+    def is_cancelled(self) -> bool:
+        # Another worker may have cancelled the job or reported it timed out
+        if not self.cancel_event.is_set() and (time.time() > self.deadline
+                                               or self.store.status(self.id) in FINISHED_STATUSES):
+            self.cancel_event.set()
+        return self.cancel_event.is_set()
+
+    def progress(self, stage: str, songs: List[Dict]):
+        self.store.update(self.id, stage=stage, partial=songs)
+
+    def finish(self, status: str, result=None, error: Optional[str] = None):
+        self.store.update(self.id, status=status, result=result, error=error, finished_at=time.time())
+
+
+def job_to_dict(record: Dict) -> Dict:
+    return {
+        "jobId": record['id'],
+        "status": record['status'],
+        "stage": record['stage'],
+        "createdAt": record['created_at'],
+        "startedAt": record['started_at'],
+        "finishedAt": record['finished_at'],
+        "songs": record['result'] if record['status'] == SUCCEEDED else (record['partial'] or []),
+        "error": record['error'],
+    }
+
+
+class JobManager:
+    """
+    Runs long generations on a small local worker pool. Job records live in a JobStore
+    shared by every worker process, so status and cancellation work from any of them. Jobs
+    cancel cooperatively between pipeline stages, while the LLM call itself is cut off at the
+    job's deadline, and are dropped JOB_RETENTION seconds after finishing; one whose worker
+    died is reported timed out once its deadline passes.
+    """
+
+    def __init__(self, max_workers: int = JOB_WORKERS, timeout: float = JOB_TIMEOUT, retention: float = JOB_RETENTION,
+                 path: str = JOB_DB_PATH):
+        self.timeout = timeout
+        self.retention = retention
+        self.max_workers = max_workers
+        self.store = JobStore(path)
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Worker threads do not survive a fork, so each process starts its own pool
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='sp-job')
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _run(self, job: Job, work: Callable[[Job], object]):
+        if job.is_cancelled():
+            job.finish(TIMED_OUT if time.time() > job.deadline else CANCELLED)
+            return
+        self.store.update(job.id, status=RUNNING, started_at=time.time())
+        try:
+            job.finish(SUCCEEDED, result=work(job))
+        except GenerationCancelled:
+            job.finish(TIMED_OUT if time.time() > job.deadline else CANCELLED)
+        except Exception as error:
+            print("Error running job:", error)
+            job.finish(FAILED, error=str(error))
+
+    def submit(self, owner: str, work: Callable[[Job], object]) -> Dict:
+        self.store.purge_finished(time.time() - self.retention)
+        now = time.time()
+        record = {"id": uuid.uuid4().hex, "owner": owner, "status": QUEUED, "created_at": now,
+                  "deadline": now + self.timeout}
+        self.store.insert(record)
+        self._get_executor().submit(self._run, Job(self.store, record['id'], record['deadline']), work)
+        return job_to_dict(self.store.get(record['id']))
+
+    def _owned(self, job_id: str, owner: str) -> Optional[Dict]:
+        record = self.store.get(job_id)
+        if record is None or record['owner'] != owner:
+            return None
+        return record
+
+    def get(self, job_id: str, owner: str) -> Optional[Dict]:
+        record = self._owned(job_id, owner)
+        if record is None:
+            return None
+        if record['status'] not in FINISHED_STATUSES and time.time() > record['deadline']:
+            # The worker notices at its next checkpoint; report the timeout right away
+            self.store.update(job_id, status=TIMED_OUT, finished_at=time.time())
+            record = self.store.get(job_id)
+        return job_to_dict(record)
+
+    def cancel(self, job_id: str, owner: str) -> Optional[Dict]:
+        if self._owned(job_id, owner) is None:
+            return None
+        # The worker running it, in whichever process, sees the status at its next checkpoint
+        self.store.update(job_id, status=CANCELLED, finished_at=time.time())
+        return self.get(job_id, owner)
+
+
+job_manager = JobManager()
@@ -0,0 +1,219 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from flask import has_request_context, request
+
+from .cache import all_cache_stats
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Path segments following these are IDs, which would make label values unbounded
+_ID_PARENTS = {'users', 'playlists', 'artists', 'tracks', 'albums', 'jobs'}
+_REQUEST_TIMINGS_KEY = 'sp_creator.timings'
+_INF_BUCKET = 'le="+Inf"'
+
+_lock = threading.Lock()
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1.0):
+        key = tuple(str(value) for value in label_values)
+        with _lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with _lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.label_names, key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *label_values: str):
+        key = tuple(str(label) for label in label_values)
+        with _lock:
+            series = self._values.get(key)
+            if series is None:
+                series = [[0] * len(self.buckets), 0.0, 0]
+                self._values[key] = series
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with _lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = _format_labels(self.label_names, key, f'le="{bound}"')
+                    lines.append(f'{self.name}_bucket{labels} {bucket_count}')
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, key, _INF_BUCKET)} {count}')
+                lines.append(f'{self.name}_sum{_format_labels(self.label_names, key)} {total}')
+                lines.append(f'{self.name}_count{_format_labels(self.label_names, key)} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors: List[Callable[[], List[str]]] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Callable[[], List[str]]):
+        """Add a callback that renders metrics computed at scrape time, such as cache ratios."""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+upstream_request_seconds = registry.register(Histogram(
+    'upstream_request_seconds', 'Latency of calls to upstream services.', ('upstream', 'endpoint')))
+upstream_responses_total = registry.register(Counter(
+    'upstream_responses_total', 'Upstream responses by status code.', ('upstream', 'endpoint', 'status')))
+upstream_retries_total = registry.register(Counter(
+    'upstream_retries_total', 'Upstream calls retried after a rate-limit or overload response.',
+    ('upstream', 'reason')))
+token_refreshes_total = registry.register(Counter(
+    'spotify_token_refreshes_total', 'Spotify access token refreshes by trigger.', ('trigger',)))
+pipeline_stage_seconds = registry.register(Histogram(
+    'pipeline_stage_seconds', 'Time spent in each stage of song generation.', ('stage',)))
+song_suggestions_total = registry.register(Counter(
+    'song_suggestions_total', 'LLM song suggestions kept or rejected by validation, by output mode.',
+    ('mode', 'outcome')))
+track_resolutions_total = registry.register(Counter(
+    'track_resolutions_total', 'Suggested songs looked up on Spotify, by where the answer came from.',
+    ('source', 'outcome')))
+http_request_seconds = registry.register(Histogram(
+    'http_request_seconds', 'Latency of requests served by this app.', ('endpoint', 'method', 'status')))
+
+
+def _render_cache_stats() -> List[str]:
+    stats = all_cache_stats()
+    lines = []
+    for name, metric_type, key, documentation in (
+            ('cache_hits_total', 'counter', 'hits', 'Cache lookups answered with a value.'),
+            ('cache_negative_hits_total', 'counter', 'negative_hits', 'Cache lookups answered with a negative entry.'),
+            ('cache_misses_total', 'counter', 'misses', 'Cache lookups that found nothing usable.'),
+            ('cache_hit_ratio', 'gauge', 'hit_ratio', 'Share of cache lookups answered from the cache.'),
+            ('cache_entries', 'gauge', 'entries', 'Entries held in the in-process tier.')):
+        lines += [f'# HELP {name} {documentation}', f'# TYPE {name} {metric_type}']
+        lines += [f'{name}{_format_labels(("cache",), (cache,))} {values[key]}' for cache, values in sorted(stats.items())]
+    return lines
+
+
+registry.register_collector(_render_cache_stats)
+
+
+def _render_resolution_hit_ratio() -> List[str]:
+    with _lock:
+        counts = dict(track_resolutions_total._values)
+    lines = ['# HELP track_resolution_hit_ratio Share of Spotify track searches that found the suggested song.',
+             '# TYPE track_resolution_hit_ratio gauge']
+    found = counts.get(('search', 'found'), 0.0)
+    searched = found + counts.get(('search', 'missing'), 0.0)
+    if searched:
+        lines.append(f'track_resolution_hit_ratio {found / searched}')
+    return lines
+
+
+registry.register_collector(_render_resolution_hit_ratio)
+
+
+def endpoint_label(endpoint: str) -> str:
+    """Collapse an upstream path to a bounded label: no query string and no IDs."""
+    segments = [segment for segment in endpoint.split('?', 1)[0].split('/') if segment]
+    for index in range(1, len(segments)):
+        if segments[index - 1] in _ID_PARENTS and re.fullmatch(r'[\w.\-]+', segments[index]) \
+                and segments[index] not in _ID_PARENTS:
+            segments[index] = '{id}'
+    return '/'.join(segments) or '/'
+
+
+def record_request_timing(name: str, seconds: float):
+    """Add seconds to name in the current request's timing breakdown, if there is a request."""
+    if not has_request_context():
+        return
+    timings = request.environ.setdefault(_REQUEST_TIMINGS_KEY, {})
+    with _lock:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+def request_timings() -> Dict[str, float]:
+    return dict(request.environ.get(_REQUEST_TIMINGS_KEY, {}))
+
+
+def observe_upstream(upstream: str, endpoint: str, status, seconds: float):
+    label = endpoint_label(endpoint)
+    upstream_request_seconds.observe(seconds, upstream, label)
+    upstream_responses_total.inc(upstream, label, status)
+    record_request_timing(upstream, seconds)
+
+
+@contextmanager
+def timed_upstream(upstream: str, endpoint: str):
+    """Time a call made through a third-party SDK rather than a PooledClient."""
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        observe_upstream(upstream, endpoint, status, time.perf_counter() - started)
+
+
+@contextmanager
+def timed_stage(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        pipeline_stage_seconds.observe(seconds, stage)
+        record_request_timing(stage, seconds)
+
+
+def server_timing_header(timings: Optional[Dict[str, float]] = None) -> str:
+    timings = request_timings() if timings is None else timings
+    return ', '.join(f'{re.sub(r"[^A-Za-z0-9_-]", "_", name)};dur={seconds * 1000:.1f}'
+                     for name, seconds in timings.items())
@@ -1,41 +1,55 @@
-from typing import Dict, Optional
+import os
+from typing import Dict, List, Optional
 
-import requests
+from .http_client import PooledClient
+from .registry import services
 
-BASE_MUSICBRAINZ_URL = "https://musicbrainz.org/ws/2/"
+BASE_MUSICBRAINZ_URL = os.environ.get('MUSICBRAINZ_URL', "https://musicbrainz.org/ws/2/")
+# MusicBrainz throttles anonymous user agents much harder than identified ones
+MUSICBRAINZ_USER_AGENT = os.environ.get('MUSICBRAINZ_USER_AGENT',
+                                        'sp-creator/1.0 ( https://github.com/dextroamphetamine/sp-creator )')
 
 
-def _make_musicbrainz_request(endpoint: str, headers: Dict[str, str], method: str = "GET",
-                              params: Optional[Dict] = None, json: Optional[Dict] = None, retries: int = 1) -> Dict:
-    url = BASE_MUSICBRAINZ_URL + endpoint
-    response = requests.request(method, url, headers=headers, params=params, json=json)
+def _musicbrainz_client():
+    return PooledClient('musicbrainz', BASE_MUSICBRAINZ_URL,
+                        pool_size=int(os.environ.get('MUSICBRAINZ_POOL_SIZE', 2)),
+                        rate=float(os.environ.get('MUSICBRAINZ_RATE', 1)),
+                        default_headers={'User-Agent': MUSICBRAINZ_USER_AGENT})
+
 
-    response.raise_for_status()
-    return response.json()
+services.register('musicbrainz', _musicbrainz_client, warm=PooledClient.connect)
 
 
-def _get_artist_info_by_names(artists: [str]):
+def _make_musicbrainz_request(endpoint: str, headers: Dict[str, str], method: str = "GET",
+                              params: Optional[Dict] = None, json: Optional[Dict] = None, retries: int = 3) -> Dict:
+    return services.get('musicbrainz').make_request(endpoint, headers, method=method, params=params, json=json,
+                                                    retries=retries)
+
+
+def _get_artist_info_by_names(artists: List[str], limit: int = 100):
     url = "artist/"
-    params = _format_artists_querey(artists)
+    params = _format_artists_query(artists)
+    params['limit'] = limit
     headers = {
         "Accept": "application/json"
     }
     return _make_musicbrainz_request(url, headers, method='GET', params=params)
 
 
-def _format_artists_querey(artists: [str]):
-    query_params = "artist:"
-    for index, artist in enumerate(artists):
-        query_params += artist
-        if index < len(artists):
-            query_params += ", "
+def _escape_lucene_phrase(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _format_artists_query(artists: List[str]):
+    query_params = " OR ".join(f'artist:"{_escape_lucene_phrase(artist)}"' for artist in artists)
 
     return {
-        'query': query_params
+        'query': query_params,
+        'fmt': 'json'
     }
 
 
-def get_artist_info(artists: [str]):
+def get_artist_info(artists: List[str]):
     artist_info = _get_artist_info_by_names(artists)
 
     return artist_info
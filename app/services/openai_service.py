@@ -1,14 +1,92 @@
+import json
+import math
 import os
 import re
+import threading
+import time
 
-import openai
+from .artist_attributes import filter_songs_by_gender
+from .cache import MISSING, TieredCache
+from .concurrency import bounded_map, get_executor
+from .metrics import song_suggestions_total, timed_upstream
+from .registry import services
+from .song_suggestions import parse_suggestion_line, suggestion_key, validate_suggestion
 
-from .musicbrainz import get_artist_info
 
-openai.api_key = os.environ.get('OPENAI_KEY')
+def _openai_sdk():
+    # The SDK pulls in aiohttp and friends, so it is imported and configured on first use
+    import openai
 
+    openai.api_key = os.environ.get('OPENAI_KEY')
+    openai.api_base = os.environ.get('OPENAI_API_BASE', openai.api_base)
+    return openai
 
-def ask_openai_for_songs(moods, activities, artists, song_count, genres=None, gender_preference=None):
+
+services.register('openai', _openai_sdk)
+
+SONG_COUNT_BUCKET = int(os.environ.get('OPENAI_CACHE_SONG_COUNT_BUCKET', 5))
+# Entries younger than OPENAI_CACHE_TTL are fresh; older ones are only served with serve_stale
+OPENAI_CACHE_TTL = float(os.environ.get('OPENAI_CACHE_TTL', 24 * 3600))
+OPENAI_CACHE_STALE_TTL = float(os.environ.get('OPENAI_CACHE_STALE_TTL', 7 * 24 * 3600))
+OPENAI_CACHE_SERVE_STALE = os.environ.get('OPENAI_CACHE_SERVE_STALE', 'true').lower() == 'true'
+# Ask for songs through a function call instead of free text
+OPENAI_STRUCTURED_OUTPUT = os.environ.get('OPENAI_STRUCTURED_OUTPUT', 'true').lower() == 'true'
+# Bumped whenever the cached value changes shape, so old entries are never read
+SONG_CACHE_FORMAT = 2
+
+song_prompt_cache = TieredCache('openai_songs',
+                                max_entries=int(os.environ.get('OPENAI_CACHE_SIZE', 2000)),
+                                ttl=max(OPENAI_CACHE_TTL, OPENAI_CACHE_STALE_TTL))
+
+# Completion budget: a numbered '"Title" by "Artist"' line is about 20 tokens and a JSON song
+# object about 30, plus a short preamble
+TOKENS_PER_SONG = int(os.environ.get('OPENAI_TOKENS_PER_SONG', 20))
+STRUCTURED_TOKENS_PER_SONG = int(os.environ.get('OPENAI_STRUCTURED_TOKENS_PER_SONG', 30))
+COMPLETION_OVERHEAD_TOKENS = 60
+MAX_COMPLETION_TOKENS = int(os.environ.get('OPENAI_MAX_COMPLETION_TOKENS', 3000))
+# Larger requests are split into this many songs per call, at most OPENAI_MAX_PARALLEL_CALLS calls
+SONGS_PER_CALL = int(os.environ.get('OPENAI_SONGS_PER_CALL', 25))
+MAX_PARALLEL_CALLS = int(os.environ.get('OPENAI_MAX_PARALLEL_CALLS', 4))
+# Seconds a completion call may take; a caller's deadline can cut it shorter
+REQUEST_TIMEOUT = float(os.environ.get('OPENAI_REQUEST_TIMEOUT', 60))
+# Titles already suggested that a top-up prompt lists as taken
+TOP_UP_EXCLUDED_TITLES = 60
+_TITLE_LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+SONG_FUNCTION = {
+    "name": "suggest_songs",
+    "description": "Return the suggested songs.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "songs": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "title": {"type": "string", "description": "Song title only, without the artist"},
+                        "artist": {"type": "string", "description": "Main artist name only"},
+                        "year": {"type": "integer", "description": "Release year, if known"},
+                        "album": {"type": "string", "description": "Album name, if known"},
+                    },
+                    "required": ["title", "artist"],
+                },
+            },
+        },
+        "required": ["songs"],
+    },
+}
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+class DeadlineExceeded(Exception):
+    """A completion call was cut off, or never started, because its caller's deadline passed."""
+
+
+def _build_song_prompt(moods, activities, artists, song_count, genres=None, gender_preference=None,
+                       title_range=None, excluded_titles=None, structured=False):
     prompt = (f"I'm looking for song recommendations. Given the mood(s) {', '.join(moods)}, "
               f"for an activity like {activities}, and preferences for artists such as {', '.join(artists)}")
 
@@ -18,56 +96,278 @@ def ask_openai_for_songs(moods, activities, artists, song_count, genres=None, ge
     if gender_preference:
         prompt += f" I would also like you to include artists that are only of the {gender_preference} gender. "
 
-    prompt += (
-        f" Please suggest specific songs in exactly this format: '\"Song Title\" by \"Artist\"'. I want exactly {song_count} number of songs.")
+    if title_range:
+        first, last = title_range
+        digits = " or a digit" if first == _TITLE_LETTERS[0] else ""
+        prompt += f" Only suggest songs whose title starts with a letter from {first} to {last}{digits}."
+
+    if excluded_titles:
+        prompt += f" Do not suggest any of these songs: {'; '.join(excluded_titles)}."
+
+    if structured:
+        prompt += f" Please suggest specific songs with the suggest_songs function. I want exactly {song_count} number of songs."
+    else:
+        prompt += (
+            f" Please suggest specific songs in exactly this format: '\"Song Title\" by \"Artist\"'. I want exactly {song_count} number of songs.")
+    return prompt
+
+
+def max_tokens_for(song_count, structured=False):
+    per_song = STRUCTURED_TOKENS_PER_SONG if structured else TOKENS_PER_SONG
+    return min(MAX_COMPLETION_TOKENS, COMPLETION_OVERHEAD_TOKENS + int(song_count) * per_song)
+
+
+def plan_song_calls(song_count):
+    """
+    Split a request for song_count songs into (count, title_range) calls that can run
+    concurrently. Each call gets its own range of title initials, so the lists they return
+    are disjoint; a request that fits one call gets no range.
+    """
+    song_count = int(song_count)
+    calls = min(MAX_PARALLEL_CALLS, len(_TITLE_LETTERS), max(1, math.ceil(song_count / SONGS_PER_CALL)))
+    if calls == 1:
+        return [(song_count, None)]
+    plan = []
+    for index in range(calls):
+        letters = _TITLE_LETTERS[index * len(_TITLE_LETTERS) // calls:(index + 1) * len(_TITLE_LETTERS) // calls]
+        count = song_count // calls + (1 if index < song_count % calls else 0)
+        plan.append((count, (letters[0], letters[-1])))
+    return plan
+
+
+def _merge_suggestions(batches):
+    """Every suggestion of every batch, in order, keeping the first of any repeated song."""
+    merged = []
+    seen = set()
+    for batch in batches:
+        for suggestion in batch:
+            if suggestion_key(suggestion) not in seen:
+                seen.add(suggestion_key(suggestion))
+                merged.append(suggestion)
+    return merged
+
+
+def _suggestions_from_text(text, mode):
+    suggestions = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        suggestion = parse_suggestion_line(line)
+        if suggestion is not None:
+            suggestions.append(suggestion)
+        elif '"' in line or '“' in line:
+            # A line that looks like a song but did not parse; chatter without quotes is not counted
+            song_suggestions_total.inc(mode, 'rejected')
+    song_suggestions_total.inc(mode, 'accepted', amount=len(suggestions))
+    return suggestions
+
+
+def _suggestions_from_arguments(arguments):
+    try:
+        items = json.loads(arguments).get("songs") or []
+    except (ValueError, AttributeError):
+        # Cut off by max_tokens: salvage every song object that was completed
+        items = []
+        for fragment in re.findall(r'\{[^{}]*\}', arguments or ''):
+            try:
+                items.append(json.loads(fragment))
+            except ValueError:
+                pass
+    suggestions = []
+    for item in items if isinstance(items, list) else []:
+        suggestion = validate_suggestion(item)
+        song_suggestions_total.inc('structured', 'accepted' if suggestion else 'rejected')
+        if suggestion is not None:
+            suggestions.append(suggestion)
+    return suggestions
+
+
+def _canonical_list(values):
+    if isinstance(values, str):
+        values = [values]
+    return sorted({" ".join(str(value).casefold().split()) for value in values or []})
+
+
+def _song_count_bucket(song_count):
+    return max(SONG_COUNT_BUCKET, math.ceil(int(song_count) / SONG_COUNT_BUCKET) * SONG_COUNT_BUCKET)
+
+
+def song_prompt_cache_key(moods, activities, artists, song_count, genres=None, gender_preference=None):
+    return json.dumps([
+        SONG_CACHE_FORMAT,
+        _canonical_list(moods),
+        _canonical_list(activities),
+        _canonical_list(artists),
+        _canonical_list(genres),
+        (gender_preference or "").casefold(),
+        _song_count_bucket(song_count),
+    ], separators=(',', ':'))
+
+
+def _complete(prompt, max_tokens, structured=False, deadline=None):
+    """
+    One completion call, returning its validated suggestions. With a deadline (a time.time()
+    value) the call gets only the time left before it and raises DeadlineExceeded when cut off.
+    """
+    options = {"functions": [SONG_FUNCTION], "function_call": {"name": "suggest_songs"}} if structured else {}
+    request_timeout = REQUEST_TIMEOUT
+    if deadline is not None:
+        request_timeout = min(request_timeout, deadline - time.time())
+        if request_timeout <= 0:
+            raise DeadlineExceeded()
+    openai = services.get('openai')
+    try:
+        with timed_upstream('openai', 'chat/completions'):
+            response = openai.ChatCompletion.create(
+                model="gpt-4",
+                messages=[{
+                    "role": "user",
+                    "content": prompt
+                }],
+                max_tokens=max_tokens,
+                request_timeout=request_timeout,
+                **options
+            )
+    except openai.error.Timeout as error:
+        if deadline is not None and time.time() >= deadline:
+            raise DeadlineExceeded() from error
+        raise
+
+    message = response.choices[0].message
+    function_call = getattr(message, "function_call", None)
+    if function_call is not None:
+        return _suggestions_from_arguments(function_call.arguments)
+    # Structured calls fall back to the text when the model answers without the function
+    return _suggestions_from_text(message.content or "", 'structured' if structured else 'text')
+
+
+def _complete_songs(moods, activities, artists, song_count, genres=None, gender_preference=None,
+                    structured=OPENAI_STRUCTURED_OUTPUT, deadline=None):
+    """
+    Generate song_count songs following plan_song_calls: the planned calls run concurrently,
+    their suggestions are merged and deduplicated, and one top-up call asks for any shortfall.
+    Every call stops at deadline, if given (see _complete).
+    """
+    def complete_part(part):
+        count, title_range = part
+        prompt = _build_song_prompt(moods, activities, artists, count, genres, gender_preference, title_range,
+                                    structured=structured)
+        return _complete(prompt, max_tokens_for(count, structured), structured, deadline)
+
+    plan = plan_song_calls(song_count)
+    if len(plan) == 1:
+        batches = [complete_part(plan[0])]
+    else:
+        batches = bounded_map(complete_part, plan, pool='openai_calls')
+    suggestions = _merge_suggestions(batches)
+
+    shortfall = int(song_count) - len(suggestions)
+    if shortfall > 0:
+        taken = [f'"{suggestion["title"]}" by {suggestion["artist"]}'
+                 for suggestion in suggestions[:TOP_UP_EXCLUDED_TITLES]]
+        prompt = _build_song_prompt(moods, activities, artists, shortfall, genres, gender_preference,
+                                    excluded_titles=taken, structured=structured)
+        suggestions = _merge_suggestions([suggestions,
+                                          _complete(prompt, max_tokens_for(shortfall, structured), structured,
+                                                    deadline)])
+
+    return suggestions
+
+
+def _refresh_cached_songs(cache_key, moods, activities, artists, song_count, genres, gender_preference):
+    try:
+        songs = _complete_songs(moods, activities, artists, song_count, genres, gender_preference)
+        song_prompt_cache.set(cache_key, {"songs": songs, "created_at": time.time()})
+    except Exception as error:
+        print("Error refreshing cached songs:", error)
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(cache_key)
+
+
+def _refresh_in_background(cache_key, *args):
+    with _refreshing_lock:
+        if cache_key in _refreshing:
+            return
+        _refreshing.add(cache_key)
+    get_executor('openai').submit(_refresh_cached_songs, cache_key, *args)
+
+
+def ask_openai_for_songs(moods, activities, artists, song_count, genres=None, gender_preference=None,
+                         serve_stale=OPENAI_CACHE_SERVE_STALE, deadline=None):
+    """
+    Ask GPT-4 for songs as validated {title, artist, year?, album?} suggestions, answering from
+    the prompt cache when an equivalent request was seen. Requests are canonicalized (order and
+    case of every list, song count rounded up to a bucket), and with serve_stale an expired
+    entry is returned at once while it refreshes in the background. A completion still running
+    at deadline is cut off with DeadlineExceeded.
+    """
+    cache_key = song_prompt_cache_key(moods, activities, artists, song_count, genres, gender_preference)
+    bucket_count = _song_count_bucket(song_count)
+    cached = song_prompt_cache.get(cache_key)
+    if cached is not MISSING:
+        is_fresh = time.time() - cached["created_at"] < OPENAI_CACHE_TTL
+        if is_fresh or serve_stale:
+            if not is_fresh:
+                _refresh_in_background(cache_key, moods, activities, artists, bucket_count, genres,
+                                       gender_preference)
+            return cached["songs"][:int(song_count)]
+
+    songs = _complete_songs(moods, activities, artists, bucket_count, genres, gender_preference,
+                            deadline=deadline)
+    song_prompt_cache.set(cache_key, {"songs": songs, "created_at": time.time()})
+    return songs[:int(song_count)]
+
+
+def stream_openai_song_pairs(moods, activities, artists, song_count, genres=None, gender_preference=None):
+    """
+    Stream the completion and yield each (title, artist) pair as soon as its line is complete.
+    Streaming reads free text, so every line goes through the same normalizer as text mode.
+    A fresh prompt-cache entry is replayed instead, and a finished stream fills the cache.
+    """
+    cache_key = song_prompt_cache_key(moods, activities, artists, song_count, genres, gender_preference)
+    cached = song_prompt_cache.get(cache_key)
+    if cached is not MISSING and time.time() - cached["created_at"] < OPENAI_CACHE_TTL:
+        for song in cached["songs"][:int(song_count)]:
+            yield song["title"], song["artist"]
+        return
+
+    bucket_count = _song_count_bucket(song_count)
+    prompt = _build_song_prompt(moods, activities, artists, bucket_count, genres, gender_preference)
+
+    songs = []
+    seen = set()
+    buffer = ""
+    # Times opening the stream, i.e. the wait before the first tokens arrive
+    with timed_upstream('openai', 'chat/completions/stream'):
+        response = services.get('openai').ChatCompletion.create(
+            model="gpt-4",
+            messages=[{
+                "role": "user",
+                "content": prompt
+            }],
+            max_tokens=max_tokens_for(bucket_count),
+            stream=True
+        )
+
+    def take(lines):
+        for song in _suggestions_from_text(lines, 'text'):
+            if suggestion_key(song) not in seen:
+                seen.add(suggestion_key(song))
+                songs.append(song)
+                if len(songs) <= int(song_count):
+                    yield song["title"], song["artist"]
 
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=[{
-            "role": "user",
-            "content": prompt
-        }],
-        max_tokens=1000
-    )
+    for chunk in response:
+        content = chunk["choices"][0]["delta"].get("content") or ""
+        buffer += content
+        if "\n" in buffer:
+            lines, buffer = buffer.rsplit("\n", 1)
+            yield from take(lines)
+    yield from take(buffer)
 
-    return response.choices[0].message.content.strip()
+    song_prompt_cache.set(cache_key, {"songs": songs, "created_at": time.time()})
 
 
 def ask_openai_to_classify_gender_and_filter_songs(artists: [dict], gender_preference: str):
-    artists_to_query: [dict] = []
-    artist_id_set: set = set()
-    artist_name_list: [str] = []
-    for artist in artists:
-        if artist['artists']:
-            for album_artist in artist['artists']:
-                if album_artist['id'] not in artist_id_set:
-                    artist_id_set.add(album_artist['id'])
-                    artists_to_query.append(album_artist)
-                    artist_name_list.append(album_artist['name'])
-
-    artist_info = get_artist_info(artist_name_list)
-
-    filtered_artists_by_gender: [dict] = []
-    for query_artist in artists_to_query:
-        found_artist: dict = {}
-        for a in artist_info['artists']:
-            if a['name'] == query_artist['name']:
-                if 'gender' in a and a['gender'] == gender_preference:
-                    filtered_artists_by_gender.append(query_artist)
-                    break
-    artist_id_list = [entry['id'] for entry in filtered_artists_by_gender]
-    return [
-        artist for artist in artists
-        if artist['artists'][0]['id'] in artist_id_list
-    ]
-
-
-def parse_openai_response(response):
-    # Regular expression pattern to match song titles and artists
-    pattern = r'\"(.*?)\" by (.*?)\n'
-    matches = re.findall(pattern, response)
-
-    # Convert matches to a list of tuples
-    song_artist_pairs = [(match[0], match[1]) for match in matches]
-
-    return song_artist_pairs
+    return filter_songs_by_gender(artists, gender_preference)
@@ -0,0 +1,154 @@
+import re
+from typing import Callable, Dict, List, Optional
+
+from .artist_index import artist_index
+from .candidate_index import candidate_index
+from .concurrency import bounded_map
+from .metrics import timed_stage
+from .openai_service import DeadlineExceeded, ask_openai_for_songs, ask_openai_to_classify_gender_and_filter_songs
+from .spotify import (RECOMMENDATIONS_FAN_OUT, resolve_songs, resolve_song_map, select_resolved_tracks,
+                      get_audio_features, get_recommendations_based_on_features, get_artist_ids_from_names,
+                      merge_songs)
+
+
+SPOTIFY_ID_PATTERN = re.compile(r'[0-9A-Za-z]{22}')
+
+
+class GenerationCancelled(Exception):
+    pass
+
+
+def _known_artist_ids(artists: List[str], artist_ids) -> Dict[str, str]:
+    """
+    Map artist names to the IDs the client sent with them, as a list parallel to artists
+    (null where unknown) or as a {name: id} object. Anything that is not a Spotify ID is dropped.
+    """
+    if isinstance(artist_ids, dict):
+        pairs = artist_ids.items()
+    elif isinstance(artist_ids, list):
+        pairs = zip(artists, artist_ids)
+    else:
+        return {}
+    return {name: artist_id for name, artist_id in pairs
+            if isinstance(artist_id, str) and SPOTIFY_ID_PATTERN.fullmatch(artist_id)}
+
+
+def song_request_from_json(data: Dict) -> Dict:
+    artists = data.get('artists', [])
+    return {
+        'moods': data.get('moods', []),
+        'activities': data.get('activities', []),
+        'artists': artists,
+        'artist_ids': _known_artist_ids(artists, data.get('artistIds')),
+        'song_count': data.get('songCount', 10),
+        'gender_preference': data.get('genderPreference', None),
+        'fan_out': data.get('fanOut', RECOMMENDATIONS_FAN_OUT),
+    }
+
+
+def get_matching_songs(tracks: List[Dict], artists: List[str], song_count: int, gender_preference: Optional[str],
+                       access_token: str, fan_out: bool = RECOMMENDATIONS_FAN_OUT,
+                       known_artist_ids: Optional[Dict[str, str]] = None) -> List[Dict]:
+    track_ids = [track['id'] for track in tracks]
+
+    # Extract artist IDs from the songs recommended by OpenAI
+    with timed_stage('artist_ids'):
+        artist_ids = get_artist_ids_from_names(artists, access_token, known_artist_ids)
+
+    # Now, pass artist_ids and track_ids as seed_artists and seed_tracks to the function
+    with timed_stage('audio_features'):
+        audio_features = get_audio_features(track_ids, access_token)
+        candidate_index.add(tracks, audio_features)
+    with timed_stage('recommendations'):
+        matching_songs = get_recommendations_based_on_features(audio_features, artist_ids, track_ids,
+                                                               num_songs=song_count, access_token=access_token,
+                                                               fan_out=fan_out)
+    artist_index.add_from_tracks(tracks + matching_songs)
+    if gender_preference is not None:
+        with timed_stage('gender_filter'):
+            matching_songs = ask_openai_to_classify_gender_and_filter_songs(matching_songs, gender_preference)
+    return matching_songs
+
+
+def _suggest(song_request: Dict, deadline: Optional[float] = None) -> List[Dict]:
+    return ask_openai_for_songs(song_request['moods'], song_request['activities'], song_request['artists'],
+                                song_request['song_count'], None, song_request['gender_preference'],
+                                deadline=deadline)
+
+
+def generate_songs(song_request: Dict, tokens: Callable[[], Optional[str]],
+                   on_progress: Optional[Callable[[str, List[Dict]], None]] = None,
+                   is_cancelled: Optional[Callable[[], bool]] = None,
+                   deadline: Optional[float] = None) -> List[Dict]:
+    """
+    Run the /search-songs pipeline for one request. Needs no request context, so it can run
+    on a job worker; on_progress gets each finished stage with the songs known so far. tokens
+    is called for the access token at each Spotify stage, so one can be refreshed in between.
+    The LLM call is cut off at deadline, which cancels the generation like is_cancelled does.
+    """
+    def checkpoint(stage, songs):
+        if is_cancelled is not None and is_cancelled():
+            raise GenerationCancelled(stage)
+        if on_progress is not None:
+            on_progress(stage, songs)
+
+    checkpoint('suggesting', [])
+
+    # 1. Use OpenAI to get song suggestions based on moods, activities, and artists
+    with timed_stage('suggest'):
+        try:
+            suggestions = _suggest(song_request, deadline)
+        except DeadlineExceeded:
+            raise GenerationCancelled('suggesting')
+
+    # 2. Suggestions are already validated and normalized, so only well-formed songs are searched
+    song_artist_pairs = [(suggestion['title'], suggestion['artist']) for suggestion in suggestions]
+    checkpoint('resolving', [])
+
+    # 3. Resolve each distinct suggestion to a Spotify track once, concurrently
+    with timed_stage('resolve'):
+        openai_songs_spotify_details, _ = resolve_songs(song_artist_pairs, tokens())
+    checkpoint('recommending', openai_songs_spotify_details)
+
+    matching_songs = get_matching_songs(openai_songs_spotify_details, song_request['artists'],
+                                        song_request['song_count'], song_request['gender_preference'], tokens(),
+                                        fan_out=song_request['fan_out'],
+                                        known_artist_ids=song_request['artist_ids'])
+
+    combined_songs = merge_songs(openai_songs_spotify_details, matching_songs)
+    checkpoint('done', combined_songs)
+    return combined_songs
+
+
+def generate_songs_batch(song_requests: List[Dict], access_token: str) -> List[List[Dict]]:
+    """
+    Run the /search-songs pipeline for several requests at once, returning each one's songs in
+    order. The LLM calls run concurrently; then every suggested song, seed artist and track is
+    resolved in one deduplicated pass, so the per-request stages that follow are served by the
+    track, artist ID and audio-feature caches and only the recommendations are per request.
+    """
+    with timed_stage('suggest'):
+        suggestions = bounded_map(_suggest, song_requests, pool='suggest')
+    pairs = [[(suggestion['title'], suggestion['artist']) for suggestion in batch] for batch in suggestions]
+
+    with timed_stage('resolve'):
+        resolved = resolve_song_map([pair for batch in pairs for pair in batch], access_token)
+    tracks = [select_resolved_tracks(batch, resolved) for batch in pairs]
+
+    known_artist_ids = {}
+    for song_request in song_requests:
+        known_artist_ids.update(song_request['artist_ids'])
+    with timed_stage('artist_ids'):
+        get_artist_ids_from_names([name for song_request in song_requests for name in song_request['artists']],
+                                  access_token, known_artist_ids)
+    with timed_stage('audio_features'):
+        get_audio_features(list(dict.fromkeys(track['id'] for batch in tracks for track in batch)), access_token)
+
+    # No user_key here: each request's stages take the user's slots themselves
+    matching = bounded_map(
+        lambda index: get_matching_songs(tracks[index], song_requests[index]['artists'],
+                                         song_requests[index]['song_count'], song_requests[index]['gender_preference'],
+                                         access_token, fan_out=song_requests[index]['fan_out'],
+                                         known_artist_ids=song_requests[index]['artist_ids']),
+        range(len(song_requests)), pool='batch')
+    return [merge_songs(batch_tracks, matching_songs) for batch_tracks, matching_songs in zip(tracks, matching)]
@@ -0,0 +1,76 @@
+import os
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+
+class ServiceRegistry:
+    """
+    Upstream clients and SDKs by name, each built by its factory on first use. Modules
+    register factories at import, which costs nothing, so configuration is read and
+    connections are set up by whichever comes first: a request needing the service or the
+    warm-up hook. A factory runs at most once per process: services built before a fork are
+    dropped in the child, which builds its own rather than share pooled sockets.
+    """
+
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._warmers: Dict[str, Callable[[Any], None]] = {}
+        self._services: Dict[str, Any] = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def register(self, name: str, factory: Callable[[], Any], warm: Optional[Callable[[Any], None]] = None):
+        """Register factory under name; warm, if given, is what warm_up does with the built service."""
+        with self._lock:
+            self._factories[name] = factory
+            if warm is not None:
+                self._warmers[name] = warm
+
+    def get(self, name: str) -> Any:
+        service = self._services.get(name)
+        if service is not None and self._pid == os.getpid():
+            return service
+        with self._lock:
+            if self._pid != os.getpid():
+                self._services = {}
+                self._pid = os.getpid()
+            service = self._services.get(name)
+            if service is None:
+                service = self._factories[name]()
+                self._services[name] = service
+            return service
+
+    def built(self) -> List[str]:
+        with self._lock:
+            return list(self._services)
+
+    def warm_up(self, names: Optional[Iterable[str]] = None) -> Dict[str, Optional[str]]:
+        """
+        Build the named services (default: all) and run their warmers. Returns each name with
+        None, or the error that stopped it; a failure never stops the others.
+        """
+        with self._lock:
+            names = list(self._factories) if names is None else list(names)
+        outcomes = {}
+        for name in names:
+            try:
+                service = self.get(name)
+                warm = self._warmers.get(name)
+                if warm is not None:
+                    warm(service)
+                outcomes[name] = None
+            except Exception as error:
+                print(f"Error warming up {name}:", error)
+                outcomes[name] = str(error) or type(error).__name__
+        return outcomes
+
+    def close(self):
+        with self._lock:
+            services, self._services = self._services, {}
+        for service in services.values():
+            close = getattr(service, 'close', None)
+            if callable(close):
+                close()
+
+
+services = ServiceRegistry()
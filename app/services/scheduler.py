@@ -0,0 +1,209 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+from .cache import CACHE_DB_PATH
+from .sqlite import SqliteConnections
+
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+IDLE_BUCKET_SECONDS = 300
+# Upstream budgets live here so every worker process on the host draws from the same one;
+# empty keeps them per process, multiplying each limit by the number of workers
+UPSTREAM_BUCKETS_PATH = os.environ.get('UPSTREAM_BUCKETS_PATH', CACHE_DB_PATH)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float, needed: float = 1.0) -> float:
+        self.refill(now)
+        blocked = max(0.0, self.blocked_until - now)
+        if self.tokens >= needed:
+            return blocked
+        return max(blocked, (needed - self.tokens) / self.rate)
+
+
+class SharedTokenBuckets:
+    """
+    Upstream token buckets in a SQLite table. Each take is one short write transaction, so
+    worker processes on the host share a budget; times are wall clock, as monotonic clocks
+    are not comparable across processes.
+    """
+
+    def __init__(self, path: str):
+        self._connection = SqliteConnections(path, [
+            "CREATE TABLE IF NOT EXISTS upstream_buckets (upstream TEXT PRIMARY KEY, tokens REAL NOT NULL,"
+            " updated REAL NOT NULL, blocked_until REAL NOT NULL)"])
+
+    def take(self, upstream: str, rate: float, capacity: float, needed: float = 1.0) -> Optional[float]:
+        """
+        Take one token when needed are available and return 0, or return how long to wait.
+        Returns None when the table cannot be used, leaving the caller to its local bucket.
+        """
+        try:
+            return self._take(upstream, rate, capacity, needed)
+        except sqlite3.Error as error:
+            print("Error taking shared upstream token:", error)
+            return None
+
+    def _take(self, upstream: str, rate: float, capacity: float, needed: float) -> float:
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = connection.execute("SELECT tokens, updated, blocked_until FROM upstream_buckets WHERE upstream = ?",
+                                     (upstream,)).fetchone()
+            tokens, updated, blocked_until = row if row is not None else (capacity, now, 0.0)
+            tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+            wait = max(0.0, blocked_until - now)
+            if tokens < needed:
+                wait = max(wait, (needed - tokens) / rate)
+            if wait <= 0:
+                tokens -= 1
+            connection.execute("INSERT OR REPLACE INTO upstream_buckets (upstream, tokens, updated, blocked_until)"
+                               " VALUES (?, ?, ?, ?)", (upstream, tokens, now, blocked_until))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return wait
+
+    def block(self, upstream: str, capacity: float, delay: float):
+        now = time.time()
+        try:
+            self._connection().execute(
+                "INSERT INTO upstream_buckets (upstream, tokens, updated, blocked_until) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (upstream) DO UPDATE SET blocked_until = MAX(blocked_until, excluded.blocked_until)",
+                (upstream, capacity, now, now + delay))
+        except sqlite3.Error as error:
+            print("Error blocking shared upstream bucket:", error)
+
+
+class UpstreamScheduler:
+    """
+    Admission control for upstream calls: one token bucket per upstream and one per
+    (upstream, access token). Lower-priority callers leave upstream tokens for any
+    higher-priority callers that are already waiting in this process. With shared buckets
+    the upstream budgets hold across worker processes; per-token buckets stay per process.
+    """
+
+    def __init__(self, shared: Optional[SharedTokenBuckets] = None):
+        self._shared = shared
+        self._condition = threading.Condition()
+        self._limits: Dict[str, Tuple[float, float, Optional[float], Optional[float]]] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._key_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._waiting: Dict[str, list] = {}
+        self._last_prune = time.monotonic()
+
+    def configure(self, upstream: str, rate: float, capacity: float,
+                  per_key_rate: Optional[float] = None, per_key_capacity: Optional[float] = None):
+        with self._condition:
+            self._limits[upstream] = (rate, capacity, per_key_rate, per_key_capacity)
+            self._buckets[upstream] = TokenBucket(rate, capacity)
+            self._waiting[upstream] = [0, 0, 0]
+
+    def _key_bucket(self, upstream: str, key: Optional[str]) -> Optional[TokenBucket]:
+        _, _, per_key_rate, per_key_capacity = self._limits[upstream]
+        if key is None or not per_key_rate:
+            return None
+        bucket = self._key_buckets.get((upstream, key))
+        if bucket is None:
+            bucket = TokenBucket(per_key_rate, per_key_capacity or per_key_rate)
+            self._key_buckets[(upstream, key)] = bucket
+        return bucket
+
+    def _prune(self, now: float):
+        if now - self._last_prune < IDLE_BUCKET_SECONDS:
+            return
+        self._last_prune = now
+        for bucket_key, bucket in list(self._key_buckets.items()):
+            if now - bucket.updated > IDLE_BUCKET_SECONDS:
+                del self._key_buckets[bucket_key]
+
+    def acquire(self, upstream: str, key: Optional[str] = None, priority: int = NORMAL):
+        if upstream not in self._limits:
+            return
+        with self._condition:
+            waiting = self._waiting[upstream]
+            waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    bucket = self._buckets[upstream]
+                    key_bucket = self._key_bucket(upstream, key)
+                    # Tokens that higher-priority waiters are entitled to are not ours to take
+                    reserved = sum(waiting[:priority])
+                    wait = key_bucket.wait_time(now) if key_bucket is not None else 0.0
+                    shared_wait = None
+                    if self._shared is not None and wait <= 0:
+                        # Taken last, so a caller held back by its own token never spends a shared one
+                        shared_wait = self._shared.take(upstream, bucket.rate, bucket.capacity, needed=1.0 + reserved)
+                    if shared_wait is not None:
+                        wait = shared_wait
+                    else:
+                        wait = max(wait, bucket.wait_time(now, needed=1.0 + reserved))
+                        if wait <= 0:
+                            bucket.tokens -= 1
+                    if wait <= 0:
+                        if key_bucket is not None:
+                            key_bucket.tokens -= 1
+                        self._prune(now)
+                        return
+                    self._condition.wait(wait)
+            finally:
+                waiting[priority] -= 1
+                self._condition.notify_all()
+
+    def penalize(self, upstream: str, delay: float, key: Optional[str] = None):
+        """Hold back every caller of upstream (or of one key on it) for delay seconds."""
+        if upstream not in self._limits:
+            return
+        with self._condition:
+            now = time.monotonic()
+            bucket = self._key_bucket(upstream, key) if key is not None else None
+            if bucket is None and self._shared is not None:
+                # Also held locally, so a failed shared update still backs this process off
+                self._shared.block(upstream, self._buckets[upstream].capacity, delay)
+            bucket = bucket or self._buckets[upstream]
+            bucket.blocked_until = max(bucket.blocked_until, now + delay)
+            self._condition.notify_all()
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int) -> float:
+    # Full jitter: spread retries of a burst over the whole backoff window
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+
+
+upstream_scheduler = UpstreamScheduler(SharedTokenBuckets(UPSTREAM_BUCKETS_PATH) if UPSTREAM_BUCKETS_PATH else None)
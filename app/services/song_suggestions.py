@@ -0,0 +1,81 @@
+import datetime
+import re
+import unicodedata
+from typing import Dict, Optional, Tuple
+
+MAX_FIELD_LENGTH = 200
+_QUOTES = '"\'“”‘’«»'
+_LIST_MARKER = re.compile(r'^\s*(?:\d+\s*[.):]|[-*•])\s*')
+# '"Title" by Artist', with the title quoted as the prompt asks; the rest is split off below
+_SONG_LINE = re.compile(r'^["“”](?P<title>.+?)["“”]\s+(?:by|-|–|—)\s+(?P<rest>.+)$',
+                        re.IGNORECASE)
+_QUOTED = re.compile(r'^["“”](?P<value>.+?)["“”](?P<tail>.*)$')
+# Commentary after the artist: ' - ...', ' (1985)', ' [live]', ', from ...', ', 1985'; a bare comma
+# belongs to the name, as in Earth, Wind & Fire
+_ARTIST_TAIL = re.compile(r'\s+[-–—(\[]|,\s*(?:from\s|(?:19|20)\d{2}\b)|\s+from\s', re.IGNORECASE)
+_YEAR = re.compile(r'\b(19\d{2}|20\d{2})\b')
+_PLACEHOLDERS = {'song title', 'title', 'artist', 'artist name'}
+
+
+def normalize_field(value) -> str:
+    """Trim list markers, wrapping quotes and extra whitespace from one text field."""
+    if not isinstance(value, str):
+        return ''
+    text = _LIST_MARKER.sub('', unicodedata.normalize('NFKC', value))
+    text = ' '.join(text.split())
+    while len(text) > 1 and text[0] in _QUOTES and text[-1] in _QUOTES:
+        text = text[1:-1].strip()
+    return text
+
+
+def _normalize_year(value) -> Optional[int]:
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value.strip())
+    if isinstance(value, int) and not isinstance(value, bool) and 1900 <= value <= datetime.date.today().year + 1:
+        return value
+    return None
+
+
+def validate_suggestion(item) -> Optional[Dict]:
+    """
+    The suggestion as {title, artist, year?, album?} with every field normalized, or None when
+    it lacks a usable title or artist. Anything rejected here never costs a Spotify search.
+    """
+    if not isinstance(item, dict):
+        return None
+    title = normalize_field(item.get('title'))
+    artist = normalize_field(item.get('artist'))
+    if not title or not artist or len(title) > MAX_FIELD_LENGTH or len(artist) > MAX_FIELD_LENGTH:
+        return None
+    if title.casefold() in _PLACEHOLDERS or artist.casefold() in _PLACEHOLDERS:
+        return None
+    suggestion = {"title": title, "artist": artist}
+    year = _normalize_year(item.get('year'))
+    if year is not None:
+        suggestion["year"] = year
+    album = normalize_field(item.get('album'))
+    if album and len(album) <= MAX_FIELD_LENGTH:
+        suggestion["album"] = album
+    return suggestion
+
+
+def parse_suggestion_line(line: str) -> Optional[Dict]:
+    """Read one free-text line such as '3. "Title" by "Artist" (1985)' into a validated suggestion."""
+    text = _LIST_MARKER.sub('', unicodedata.normalize('NFKC', line or '')).strip()
+    match = _SONG_LINE.match(text)
+    if match is None:
+        return None
+    rest = match.group('rest').strip()
+    quoted = _QUOTED.match(rest)
+    if quoted is not None:
+        artist, tail = quoted.group('value'), quoted.group('tail')
+    else:
+        split = _ARTIST_TAIL.search(rest)
+        artist, tail = (rest[:split.start()], rest[split.start():]) if split else (rest, '')
+    year = _YEAR.search(tail)
+    return validate_suggestion({"title": match.group('title'), "artist": artist.rstrip(' .,;'),
+                                "year": int(year.group(1)) if year else None})
+
+
+def suggestion_key(suggestion: Dict) -> Tuple[str, str]:
+    return " ".join(suggestion["title"].casefold().split()), " ".join(suggestion["artist"].casefold().split())
@@ -1,48 +1,145 @@
 import base64
+import hashlib
+import json
 import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from itertools import zip_longest
 from typing import Dict, Optional
 
-import requests
-from flask import session
-
-BASE_SPOTIFY_URL = "https://api.spotify.com/v1/"
-CLIENT_ID = os.environ.get('CLIENT_ID')
-CLIENT_SECRET = os.environ.get('CLIENT_SECRET')
+from flask import copy_current_request_context, current_app, g, has_request_context, session
+
+from .artist_attributes import filter_songs_by_gender
+from .artist_index import artist_index, normalize_query
+from .audio_profile import FeatureMatrix, profile_vector, vector_to_profile
+from .cache import MISSING, TieredCache
+from .candidate_index import candidate_index
+from .concurrency import SingleFlight, bounded_map, chunked, get_executor, submit_bounded
+from .feature_store import get_features
+from .http_client import PooledClient
+from .metrics import token_refreshes_total, track_resolutions_total
+from .registry import services
+from .scheduler import BULK, INTERACTIVE, NORMAL
+from .tracks import compact_track
+
+# Overridable so the service can run against local stand-ins (see bench/)
+BASE_SPOTIFY_URL = os.environ.get('SPOTIFY_API_URL', "https://api.spotify.com/v1/")
+BASE_SPOTIFY_ACCOUNTS_URL = os.environ.get('SPOTIFY_ACCOUNTS_URL', "https://accounts.spotify.com/")
 BASE_FLASK_URI = 'http://127.0.0.1:8080'
 BASE_URI = 'http://127.0.0.1:5173'
 REDIRECT_URI = f'{BASE_FLASK_URI}/callback'
+DEFAULT_MARKET = os.environ.get('SPOTIFY_MARKET', 'CA')
+PLAYLIST_TRACKS_BATCH_SIZE = 100
+LOCAL_RECOMMENDATIONS = os.environ.get('LOCAL_RECOMMENDATIONS', 'true').lower() == 'true'
+LOCAL_RECOMMENDATIONS_MIN_INDEX = int(os.environ.get('LOCAL_RECOMMENDATIONS_MIN_INDEX', 500))
+LOCAL_RECOMMENDATIONS_MAX_DISTANCE = float(os.environ.get('LOCAL_RECOMMENDATIONS_MAX_DISTANCE', 0.5))
+RECOMMENDATIONS_FAN_OUT = os.environ.get('RECOMMENDATIONS_FAN_OUT', 'false').lower() == 'true'
+RECOMMENDATION_SEED_LIMIT = 5
+RECOMMENDATIONS_LIMIT = 100
+AVERAGED_FEATURES = ('acousticness', 'danceability', 'energy', 'instrumentalness', 'key', 'liveness', 'loudness',
+                     'mode', 'speechiness', 'tempo', 'valence', 'time_signature')
+
+# Resolved (title, artist, market) lookups; None marks a suggestion Spotify could not find
+track_cache = TieredCache('tracks',
+                          max_entries=int(os.environ.get('TRACK_CACHE_SIZE', 20000)),
+                          ttl=float(os.environ.get('TRACK_CACHE_TTL', 7 * 24 * 3600)),
+                          negative_ttl=float(os.environ.get('TRACK_CACHE_NEGATIVE_TTL', 24 * 3600)))
+
+_STREAM_DONE = object()
+
+ARTIST_SEARCH_LIMIT = 10
+# Upstream artist searches younger than this are fresh; older ones are refreshed in the background
+ARTIST_SEARCH_REFRESH_INTERVAL = float(os.environ.get('ARTIST_SEARCH_REFRESH_INTERVAL', 24 * 3600))
+# Normalized queries sent upstream, with when and how many artists came back
+artist_search_cache = TieredCache('artist_searches',
+                                  max_entries=int(os.environ.get('ARTIST_SEARCH_CACHE_SIZE', 20000)),
+                                  ttl=float(os.environ.get('ARTIST_SEARCH_CACHE_TTL', 30 * 24 * 3600)))
+_artist_searches = SingleFlight()
+
+GENRE_SEEDS_KEY = 'available-genre-seeds'
+# The seed list is the same for every user and rarely changes
+GENRE_SEEDS_REFRESH_INTERVAL = float(os.environ.get('GENRE_SEEDS_REFRESH_INTERVAL', 24 * 3600))
+genre_seed_cache = TieredCache('genre_seeds', max_entries=1,
+                               ttl=float(os.environ.get('GENRE_SEEDS_CACHE_TTL', 30 * 24 * 3600)))
+_genre_seed_fetches = SingleFlight()
+# Normalized artist name -> Spotify artist ID; None marks a name Spotify did not know
+artist_id_cache = TieredCache('artist_ids',
+                              max_entries=int(os.environ.get('ARTIST_ID_CACHE_SIZE', 20000)),
+                              ttl=float(os.environ.get('ARTIST_ID_CACHE_TTL', 30 * 24 * 3600)),
+                              negative_ttl=float(os.environ.get('ARTIST_ID_CACHE_NEGATIVE_TTL', 24 * 3600)))
+
+# Refresh this many seconds before the access token expires
+TOKEN_REFRESH_MARGIN = float(os.environ.get('TOKEN_REFRESH_MARGIN', 60))
+_token_refreshes = SingleFlight()
+_recent_refreshes = {}
+_recent_refreshes_lock = threading.Lock()
+
+def _spotify_api_client():
+    return PooledClient('spotify_api', BASE_SPOTIFY_URL,
+                        pool_size=int(os.environ.get('SPOTIFY_API_POOL_SIZE', 32)),
+                        rate=float(os.environ.get('SPOTIFY_API_RATE', 30)),
+                        burst=float(os.environ.get('SPOTIFY_API_BURST', 60)),
+                        per_key_rate=float(os.environ.get('SPOTIFY_API_RATE_PER_TOKEN', 10)),
+                        per_key_burst=float(os.environ.get('SPOTIFY_API_BURST_PER_TOKEN', 20)))
+
+
+def _spotify_accounts_client():
+    return PooledClient('spotify_accounts', BASE_SPOTIFY_ACCOUNTS_URL,
+                        pool_size=int(os.environ.get('SPOTIFY_ACCOUNTS_POOL_SIZE', 4)),
+                        rate=float(os.environ.get('SPOTIFY_ACCOUNTS_RATE', 5)))
+
+
+services.register('spotify_api', _spotify_api_client, warm=PooledClient.connect)
+services.register('spotify_accounts', _spotify_accounts_client, warm=PooledClient.connect)
+
+
+def client_credentials():
+  """The app's Spotify client ID and secret, read when first needed rather than at import."""
+  return os.environ.get('CLIENT_ID'), os.environ.get('CLIENT_SECRET')
+
+
+def _basic_auth_header():
+  client_id, client_secret = client_credentials()
+  return base64.b64encode(f"{client_id}:{client_secret}".encode('utf-8')).decode('utf-8')
 
 
 def get_spotify_auth(code):
-  url = "https://accounts.spotify.com/api/token"
-  auth_header = base64.b64encode(
-    f"{CLIENT_ID}:{CLIENT_SECRET}".encode('utf-8')).decode('utf-8')
-  headers = {"Authorization": f"Basic {auth_header}"}
+  headers = {"Authorization": f"Basic {_basic_auth_header()}"}
   data = {
     "grant_type": "authorization_code",
     "code": code,
     "redirect_uri": REDIRECT_URI
   }
-  response = requests.post(url, headers=headers, data=data)
+  response = services.get('spotify_accounts').request("POST", "api/token", headers=headers, data=data)
   if response.status_code != 200:
     response_data = response.json()
     print("Error getting access token:", response_data)
-    return None, None
+    return None, None, None
 
   response_data = response.json()
-  return response_data["access_token"], response_data["refresh_token"]
+  return response_data["access_token"], response_data["refresh_token"], response_data.get("expires_in")
 
 
 # Implement make_spotify_request based on the interface
-def make_spotify_request(endpoint: str, headers: Dict[str, str], method: str = "GET", params: Optional[Dict] = None, json: Optional[Dict] = None, retries: int = 1) -> Dict:
-    url = BASE_SPOTIFY_URL + endpoint
-    response = requests.request(method, url, headers=headers, params=params, json=json)
+def make_spotify_request(endpoint: str, headers: Dict[str, str], method: str = "GET", params: Optional[Dict] = None, json: Optional[Dict] = None, retries: int = 1, priority: int = NORMAL) -> Dict:
+    response = services.get('spotify_api').request(method, endpoint, priority=priority, headers=headers, params=params, json=json)
     
-    if response.status_code == 401 and retries:
-        success = refresh_access_token(session.get('refresh_token'))
+    if response.status_code == 401 and retries and has_request_context():
+        token_refreshes_total.inc('unauthorized')
+        # A streamed response has saved its session already, so it refreshes through its SessionTokens
+        tokens = g.get('session_tokens')
+        if tokens is not None:
+            success = tokens.refresh()
+            access_token = tokens.access_token
+        else:
+            success = refresh_access_token(session.get('refresh_token'))
+            access_token = session.get('access_token')
         if success:
-            headers['Authorization'] = f"Bearer {session['access_token']}"
-            return make_spotify_request(endpoint, headers, method=method, params=params, json=json, retries=0)
+            headers['Authorization'] = f"Bearer {access_token}"
+            return make_spotify_request(endpoint, headers, method=method, params=params, json=json, retries=0,
+                                        priority=priority)
     
     response.raise_for_status()
     return response.json()
@@ -51,7 +148,8 @@ def make_spotify_request(endpoint: str, headers: Dict[str, str], method: str = "
 
 def search_artists(query, access_token):
     headers = {'Authorization': f'Bearer {access_token}'}
-    response = make_spotify_request(f'search?q={query}&type=artist&limit=10', headers=headers)
+    response = make_spotify_request(f'search?q={query}&type=artist&limit=10', headers=headers,
+                                    priority=INTERACTIVE)
     
     # Use key lookups instead of dot notation
     if 'artists' not in response or not response['artists']['items']:
@@ -63,16 +161,74 @@ def search_artists(query, access_token):
         "name": artist["name"],
         "image_url": artist['images'][0]['url'] if artist['images'] else None
     } for artist in artists_data]
+    artist_index.add([dict(artist, popularity=artists_data[index].get('popularity'))
+                      for index, artist in enumerate(artists)])
     
     return artists
 
 
+def _fetch_artist_search(normalized_query, access_token):
+    # Every keystroke of every user typing the same query shares this one upstream call
+    def fetch():
+        artists = search_artists(normalized_query, access_token)
+        artist_search_cache.set(normalized_query, {"count": len(artists), "fetched_at": time.time()})
+        return artists
+    return _artist_searches.do(normalized_query, fetch)
+
+
+def _refresh_artist_search(normalized_query, access_token):
+    try:
+        record = artist_search_cache.get(normalized_query)
+        if record is MISSING or time.time() - record["fetched_at"] >= ARTIST_SEARCH_REFRESH_INTERVAL:
+            _fetch_artist_search(normalized_query, access_token)
+    except Exception as error:
+        print("Error refreshing artist search:", error)
+
+
+def _covered_by_earlier_search(normalized_query):
+    """Whether this query or a prefix of it was searched upstream and came back short of the limit."""
+    for end in range(len(normalized_query), 0, -1):
+        record = artist_search_cache.get(normalized_query[:end])
+        if record is not MISSING:
+            return end == len(normalized_query) or record["count"] < ARTIST_SEARCH_LIMIT
+    return False
+
+
+def suggest_artists(query, access_token, limit=ARTIST_SEARCH_LIMIT):
+    """
+    Artist autocomplete, answered from the local artist index. Spotify is only searched
+    while the index cannot answer a query that no earlier search covers; otherwise a stale
+    search is refreshed in the background and the local answer returns at once.
+    """
+    normalized_query = normalize_query(query)
+    if not normalized_query:
+        return []
+    local = artist_index.search(normalized_query, limit)
+    if len(local) < limit and not _covered_by_earlier_search(normalized_query):
+        _fetch_artist_search(normalized_query, access_token)
+        return artist_index.search(normalized_query, limit)
+
+    record = artist_search_cache.get(normalized_query)
+    if record is not MISSING and time.time() - record["fetched_at"] >= ARTIST_SEARCH_REFRESH_INTERVAL:
+        get_executor('artist_search', max_workers=2).submit(_refresh_artist_search, normalized_query, access_token)
+    return local
+
+
 def get_user_id(access_token):
   headers = {"Authorization": f"Bearer {access_token}"}
   response = make_spotify_request("me", headers=headers)
   return response["id"]
 
 
+def get_session_user_id(access_token):
+  # The user behind a session never changes, so look it up once per login
+  user_id = session.get('user_id')
+  if user_id is None:
+    user_id = get_user_id(access_token)
+    session['user_id'] = user_id
+  return user_id
+
+
 def create_playlist(access_token, user_id, playlist_name):
     headers = {
         "Authorization": f"Bearer {access_token}",
@@ -86,39 +242,36 @@ def create_playlist(access_token, user_id, playlist_name):
     return response
 
 def add_tracks_to_playlist(access_token, playlist_id, track_ids):
+    """
+    Append tracks in upstream-sized chunks, in order, over the kept-alive API connection.
+    Returns the last response, whose snapshot_id reflects every chunk.
+    """
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json"
     }
-    data = {"uris": [f"spotify:track:{track_id}" for track_id in track_ids]}
-    response = make_spotify_request(f'playlists/{playlist_id}/tracks', headers=headers, method="POST", json=data)
+    response = {}
+    for chunk in chunked(list(track_ids), PLAYLIST_TRACKS_BATCH_SIZE):
+        data = {"uris": [f"spotify:track:{track_id}" for track_id in chunk]}
+        response = make_spotify_request(f'playlists/{playlist_id}/tracks', headers=headers, method="POST", json=data)
     return response
 
 
 
-def get_spotify_track_ids(song_titles, artists, access_token):
-  track_ids = []
+def _fetch_audio_features_batch(track_ids, access_token):
   headers = {'Authorization': f'Bearer {access_token}'}
-  for title, artist in zip(song_titles, artists):
-    query = f'track:"{title}" artist:"{artist}"'
-    response = make_spotify_request(f'search?q={query}&type=track&limit=1',
-                                    headers=headers)
-    tracks = response['tracks']['items']
-    if tracks:
-      track_ids.append(tracks[0]['id'])
-  return track_ids
-
-
-def get_audio_features(track_ids, access_token):
-  headers = {'Authorization': f'Bearer {access_token}'}
-  track_ids_str = ",".join(track_ids)
-  response = make_spotify_request(f'audio-features?ids={track_ids_str}',
-                                  headers=headers)
+  response = make_spotify_request('audio-features', headers=headers, params={'ids': ",".join(track_ids)},
+                                  priority=BULK)
   if not response:
     return []
   return response["audio_features"]
 
 
+def get_audio_features(track_ids, access_token):
+  return get_features(track_ids, lambda batch: _fetch_audio_features_batch(batch, access_token),
+                      user_key=access_token)
+
+
 def get_songs_matching_mood(audio_features, sentiment):
   # Your logic to match songs based on audio features and sentiment
   # This is a placeholder, you can replace it with your actual logic
@@ -132,28 +285,14 @@ def get_songs_matching_mood(audio_features, sentiment):
 
 
 def get_common_audio_profile(audio_features_list):
-  summed_features = {feature: 0 for feature in audio_features_list[0]}
-
-  for features in audio_features_list:
-    for key, value in features.items():
-      if not isinstance(value, str):
-        summed_features[key] += value
-
-  num_songs = len(audio_features_list)
-  average_features = {
-    key: value / num_songs
-    for key, value in summed_features.items()
-  }
-
-  return average_features
+  return vector_to_profile(FeatureMatrix.from_features(audio_features_list).mean())
 
 
 def find_songs_matching_profile(average_features, access_token, tolerance=0.1):
   headers = {'Authorization': f'Bearer {access_token}'}
 
   # Fetch top tracks or tracks from specific genres as a sample
-  response = requests.get(f"{BASE_SPOTIFY_URL}/browse/top-lists",
-                          headers=headers)
+  response = services.get('spotify_api').request("GET", "browse/top-lists", headers=headers)
   track_ids = [
     track['id']
     for track in response.json().get('tracks', {}).get('items', [])
@@ -163,134 +302,451 @@ def find_songs_matching_profile(average_features, access_token, tolerance=0.1):
   track_features = get_audio_features(track_ids, access_token)
 
   # Filter tracks based on our desired audio feature profile
-  matching_songs = []
-  for features in track_features:
-    is_match = all((1 - tolerance) * average_features[key] <= features[key] <=
-                   (1 + tolerance) * average_features[key]
-                   for key in average_features)
-    if is_match:
-      matching_songs.append(features['id'])
+  matrix = FeatureMatrix.from_features(track_features)
+  is_match = matrix.within_tolerance(profile_vector(average_features), tolerance)
+  return [track_id for track_id, matched in zip(matrix.ids, is_match) if matched]
 
-  return matching_songs
 
+def _round_or_none(value):
+    return round(value) if value is not None else None
 
-def get_recommendations_based_on_features(features, seed_artists=None, seed_tracks=None, genres=None, num_songs=10):
-    headers = {"Authorization": f"Bearer {session['access_token']}"}
+
+def get_recommendations_based_on_features(features, seed_artists=None, seed_tracks=None, genres=None, num_songs=10,
+                                          access_token=None, fan_out=RECOMMENDATIONS_FAN_OUT):
+    if access_token is None:
+        access_token = session['access_token']
+    headers = {"Authorization": f"Bearer {access_token}"}
 
     features = get_average_audio_features(features)
 
     params = {
-        "market": "CA",
+        "market": DEFAULT_MARKET,
         "limit": num_songs,
         "target_acousticness": features.get("acousticness"),
         "target_danceability": features.get("danceability"),
         "target_duration_ms": features.get("duration_ms"),
         "target_energy": features.get("energy"),
         "target_instrumentalness": features.get("instrumentalness"),
-        "target_key": round(features.get("key")),  # Round the key value
+        "target_key": _round_or_none(features.get("key")),  # Round the key value
         "target_liveness": features.get("liveness"),
         "target_loudness": features.get("loudness"),
         "target_popularity": features.get("popularity"),
         "target_speechiness": features.get("speechiness"),
         "target_tempo": features.get("tempo"),
-        "target_time_signature": round(features.get("time_signature")),
+        "target_time_signature": _round_or_none(features.get("time_signature")),
         "target_valence": features.get("valence")
     }
 
     params = {k: v for k, v in params.items() if v is not None}
 
-    if seed_artists:
-        params["seed_artists"] = ",".join(seed_artists[:5])  # Limit to 5 seed artists
-
-    remaining_seeds = 5 - len(params.get("seed_artists", "").split(","))
-  
-    if seed_tracks and remaining_seeds > 0:
-        params["seed_tracks"] = ",".join(seed_tracks[:remaining_seeds])
-
-    response = make_spotify_request("recommendations", headers=headers, params=params)
-    return response.get("tracks", [])
+    # Serve from the local index of tracks we have already seen; Spotify only fills the shortfall
+    local_songs = []
+    if LOCAL_RECOMMENDATIONS and len(candidate_index) >= LOCAL_RECOMMENDATIONS_MIN_INDEX:
+        local_songs = candidate_index.nearest(features, num_songs, exclude_ids=set(seed_tracks or []),
+                                              max_distance=LOCAL_RECOMMENDATIONS_MAX_DISTANCE)
+        if len(local_songs) >= num_songs:
+            return local_songs
+        params["limit"] = num_songs - len(local_songs)
+
+    seed_groups = _seed_groups(seed_artists or [], seed_tracks or [], valid_genre_seeds(genres, access_token),
+                               fan_out)
+    if not seed_groups:
+        # Spotify rejects a recommendations call without seeds
+        return local_songs
+    if len(seed_groups) == 1:
+        tracks = _request_recommendations(headers, dict(params, **seed_groups[0]))
+    else:
+        limit = min(num_songs, RECOMMENDATIONS_LIMIT)
+        results = bounded_map(lambda group: _request_recommendations(headers, dict(params, limit=limit, **group)),
+                              seed_groups, user_key=access_token, pool='recommend')
+        tracks = _rank_by_profile(merge_songs([], [track for result in results for track in result]), features,
+                                  access_token)
+
+    local_ids = {song['id'] for song in local_songs}
+    tracks = [track for track in tracks if track['id'] not in local_ids]
+    return local_songs + tracks[:params["limit"]]
+
+
+def _seed_groups(seed_artists, seed_tracks, genres, fan_out):
+  """
+  Split seeds into groups Spotify accepts (at most five seeds per call). Without fan_out only the
+  first group is used: artists first, then tracks, then genres. With fan_out every seed is used and
+  artists and tracks are interleaved so each group mixes both.
+  """
+  if not fan_out:
+    seeds = [("seed_artists", seed) for seed in seed_artists] + [("seed_tracks", seed) for seed in seed_tracks]
+  else:
+    artist_seeds = [("seed_artists", seed) for seed in seed_artists]
+    track_seeds = [("seed_tracks", seed) for seed in seed_tracks]
+    seeds = [seed for pair in zip_longest(artist_seeds, track_seeds) for seed in pair if seed is not None]
+  seeds += [("seed_genres", genre) for genre in genres]
+
+  groups = []
+  for chunk in chunked(seeds, RECOMMENDATION_SEED_LIMIT):
+    group = {}
+    for seed_type, seed in chunk:
+      group[seed_type] = f"{group[seed_type]},{seed}" if seed_type in group else seed
+    groups.append(group)
+  return groups if fan_out else groups[:1]
+
+
+def _request_recommendations(headers, params):
+  response = make_spotify_request("recommendations", headers=headers, params=params)
+  return [compact_track(track) for track in response.get("tracks", [])]
+
+
+def _rank_by_profile(tracks, target_features, access_token):
+  """Order tracks by distance to the target profile; tracks without audio features go last."""
+  audio_features = get_audio_features([track['id'] for track in tracks], access_token)
+  candidate_index.add(tracks, audio_features)
+  matrix = FeatureMatrix.from_features(audio_features)
+  distances = dict(zip(matrix.ids, matrix.distances(profile_vector(target_features))))
+  return sorted(tracks, key=lambda track: distances.get(track['id'], float('inf')))
 
 
 def get_average_audio_features(audio_features_list):
     """
     Compute the average audio features from a list of audio features.
     """
-    # Initialize a dictionary to store the sum of each feature
-    summed_features = {
-        'acousticness': 0,
-        'danceability': 0,
-        'energy': 0,
-        'instrumentalness': 0,
-        'key': 0,
-        'liveness': 0,
-        'loudness': 0,
-        'mode': 0,
-        'speechiness': 0,
-        'tempo': 0,
-        'valence': 0,
-        'time_signature': 0
-    }
+    average = FeatureMatrix.from_features(audio_features_list).mean()
 
-    # Sum up all the features
-    for features in audio_features_list:
-        for key in summed_features:
-            if features[key] is not None and not isinstance(features[key], str):
-                summed_features[key] += features[key]
-
-    # Calculate the average for each feature and round to 2 decimal places
-    num_songs = len(audio_features_list)
-    avg_features = {
-        key: round(value / num_songs, 2)
-        for key, value in summed_features.items()
-    }
-
-    return dict(filter(lambda item: item[1] is not None, avg_features.items()))
+    # Round to 2 decimal places; features no song has are left out
+    return {key: round(value, 2) for key, value in vector_to_profile(average, AVERAGED_FEATURES).items()}
 
 
-def refresh_access_token(refresh_token):
-  client_creds = base64.b64encode(
-    f"{CLIENT_ID}:{CLIENT_SECRET}".encode()).decode()
-
+def _request_token_refresh(refresh_token):
   headers = {
-    "Authorization": f"Basic {client_creds}",
+    "Authorization": f"Basic {_basic_auth_header()}",
   }
 
   data = {'grant_type': 'refresh_token', 'refresh_token': refresh_token}
 
-  response = requests.post('https://accounts.spotify.com/api/token',
-                           data=data,
-                           headers=headers)
+  response = services.get('spotify_accounts').request("POST", "api/token", data=data, headers=headers)
 
   if response.status_code != 200:
+    return None
+
+  response_data = response.json()
+  tokens = {
+    "access_token": response_data["access_token"],
+    # Spotify may rotate the refresh token; keep using the old one when it does not
+    "refresh_token": response_data.get("refresh_token") or refresh_token,
+    "expires_at": time.time() + response_data.get("expires_in", 3600),
+  }
+  with _recent_refreshes_lock:
+    _recent_refreshes[refresh_token] = tokens
+  return tokens
+
+
+def refresh_tokens(refresh_token):
+  """
+  Exchange a refresh token for new tokens, sharing one accounts call among concurrent callers.
+  Callers that still hold a refresh token that was just used get the result of that refresh,
+  since the token may already have been rotated away.
+  """
+  if not refresh_token:
+    return None
+  with _recent_refreshes_lock:
+    recent = _recent_refreshes.get(refresh_token)
+    if recent is not None and recent["expires_at"] - time.time() > TOKEN_REFRESH_MARGIN:
+      return recent
+    for old_token, tokens in list(_recent_refreshes.items()):
+      if tokens["expires_at"] - time.time() <= TOKEN_REFRESH_MARGIN:
+        del _recent_refreshes[old_token]
+  return _token_refreshes.do(refresh_token, lambda: _request_token_refresh(refresh_token))
+
+
+def store_session_tokens(access_token, refresh_token, expires_in=None):
+  session['access_token'] = access_token
+  session['refresh_token'] = refresh_token
+  if expires_in is not None:
+    session['access_token_expires_at'] = time.time() + expires_in
+  else:
+    session.pop('access_token_expires_at', None)
+
+
+def refresh_access_token(refresh_token):
+  tokens = refresh_tokens(refresh_token)
+  if tokens is None:
     session.pop('access_token', None)
     return False
 
-  response_data = response.json()
-  session['access_token'] = response_data['access_token']
+  store_session_tokens(tokens["access_token"], tokens["refresh_token"], tokens["expires_at"] - time.time())
   return True
 
 
-def get_artist_ids_from_names(artist_names, access_token):
-  artist_ids = []
+def ensure_fresh_access_token():
+  """Refresh the session's access token shortly before it expires, instead of after a 401."""
+  expires_at = session.get('access_token_expires_at')
+  if 'access_token' not in session or expires_at is None:
+    return session.get('access_token')
+  if expires_at - time.time() <= TOKEN_REFRESH_MARGIN:
+    token_refreshes_total.inc('proactive')
+    refresh_access_token(session.get('refresh_token'))
+  return session.get('access_token')
+
+
+class SessionTokens:
+  """
+  A login's tokens for work that outlives its request, such as a streamed response or a job.
+  Called, it returns the access token, refreshed shortly before it expires. The request has
+  saved its session by then, so refreshed tokens are written to the session store by session
+  ID; the next request would otherwise present a refresh token Spotify may have rotated away.
+  """
+
+  def __init__(self, access_token, refresh_token, expires_at=None, sid=None, session_interface=None):
+    self.access_token = access_token
+    self.refresh_token = refresh_token
+    self.expires_at = expires_at
+    self.sid = sid
+    self._session_interface = session_interface
+    self._lock = threading.Lock()
+
+  @classmethod
+  def from_session(cls):
+    return cls(session.get('access_token'), session.get('refresh_token'), session.get('access_token_expires_at'),
+               getattr(session, 'sid', None), current_app.session_interface)
+
+  def __call__(self):
+    with self._lock:
+      if self.expires_at is not None and self.expires_at - time.time() <= TOKEN_REFRESH_MARGIN:
+        token_refreshes_total.inc('proactive')
+        self._refresh()
+      return self.access_token
+
+  def refresh(self):
+    """Refresh now, e.g. after Spotify rejected the access token. Returns whether it worked."""
+    with self._lock:
+      return self._refresh()
+
+  def _refresh(self):
+    stored = self._stored()
+    if stored and stored.get('access_token') not in (None, self.access_token):
+      # Another request refreshed this login first, possibly rotating the refresh token
+      self.access_token = stored['access_token']
+      self.refresh_token = stored.get('refresh_token') or self.refresh_token
+      self.expires_at = stored.get('access_token_expires_at')
+      if self.expires_at is None or self.expires_at - time.time() > TOKEN_REFRESH_MARGIN:
+        return True
+    tokens = refresh_tokens(self.refresh_token)
+    if tokens is None:
+      return False
+    self.access_token = tokens["access_token"]
+    self.refresh_token = tokens["refresh_token"]
+    self.expires_at = tokens["expires_at"]
+    self._save()
+    return True
+
+  def _stored(self):
+    load = getattr(self._session_interface, 'load_session_data', None)
+    if self.sid is None or load is None:
+      return None
+    try:
+      return load(self.sid)
+    except Exception as error:
+      print("Error reading session tokens:", error)
+      return None
+
+  def _save(self):
+    update = getattr(self._session_interface, 'update_session_data', None)
+    if self.sid is None or update is None:
+      return
+    try:
+      update(self.sid, {"access_token": self.access_token, "refresh_token": self.refresh_token,
+                        "access_token_expires_at": self.expires_at})
+    except Exception as error:
+      print("Error saving refreshed session tokens:", error)
+
+
+def _best_artist_match(normalized_name, artists):
+  # Prefer an exact name match; otherwise trust Spotify's relevance order
+  for artist in artists:
+    if normalize_query(artist['name']) == normalized_name:
+      return artist['id']
+  return artists[0]['id'] if artists else None
+
+
+def _resolve_artist_id(normalized_name, access_token):
+  # The index ranks by popularity, so of several known artists sharing the name the best-known wins
+  exact = [artist for artist in artist_index.search(normalized_name, ARTIST_SEARCH_LIMIT)
+           if normalize_query(artist['name']) == normalized_name]
+  if exact:
+    artist_id = exact[0]['id']
+  else:
+    artist_id = _best_artist_match(normalized_name, search_artists(normalized_name, access_token))
+  artist_id_cache.set(normalized_name, artist_id)
+  return artist_id
+
+
+def get_artist_ids_from_names(artist_names, access_token, known_ids=None):
+  """
+  Resolve artist names to one Spotify artist ID each, in order and without duplicates.
+  known_ids maps names to IDs the client already has; the rest come from the artist ID
+  cache, then the local artist index, then concurrent Spotify searches.
+  """
+  known_ids = known_ids or {}
+  names = {}
   for name in artist_names:
-    search_results = search_artists(name, access_token)
-  for artist in search_results:
-    artist_ids.append(artist['id'])
+    if known_ids.get(name):
+      names.setdefault(name, None)
+    elif normalize_query(name):
+      names.setdefault(name, normalize_query(name))
+
+  to_resolve = {normalized for normalized in names.values() if normalized}
+  resolved = artist_id_cache.get_many(to_resolve)
+  missing = [normalized for normalized in to_resolve if normalized not in resolved]
+  if missing:
+    resolved.update(zip(missing, bounded_map(lambda normalized: _resolve_artist_id(normalized, access_token),
+                                             missing, user_key=access_token, pool='resolve')))
 
+  artist_ids = []
+  for name, normalized in names.items():
+    artist_id = known_ids.get(name) if normalized is None else resolved.get(normalized)
+    if artist_id and artist_id not in artist_ids:
+      artist_ids.append(artist_id)
   return artist_ids
 
 
-def get_song_details_from_spotify(song_title, artist_name):
-  headers = {"Authorization": f"Bearer {session['access_token']}"}
-  query = f"{song_title} artist:{artist_name}"
-  params = {"q": query, "type": "track", "limit": 1}
+def _field_query_value(value):
+  return " ".join(value.replace('"', ' ').split())
 
-  # Construct the URL with embedded query parameters
-  base_url = 'https://api.spotify.com/v1/search'
-  query_string = "&".join([f"{key}={value}" for key, value in params.items()])
-  response = make_spotify_request(f"search?{query_string}", headers=headers)
+
+def get_song_details_from_spotify(song_title, artist_name, access_token=None, market=DEFAULT_MARKET):
+  if access_token is None:
+    access_token = session['access_token']
+  headers = {"Authorization": f"Bearer {access_token}"}
+  # Field filters on both the title and the artist, so the one result is the song itself
+  query = f'track:"{_field_query_value(song_title)}" artist:"{_field_query_value(artist_name)}"'
+  params = {"q": query, "type": "track", "limit": 1, "market": market}
+
+  response = make_spotify_request("search", headers=headers, params=params, priority=BULK)
   tracks = response['tracks']['items']
-  return tracks[0] if tracks else None
+  return compact_track(tracks[0]) if tracks else None
+
+
+def _song_cache_key(song_title, artist_name, market):
+  normalized_title = " ".join(song_title.casefold().split())
+  normalized_artist = " ".join(artist_name.casefold().split())
+  return f"{market}|{normalized_title}|{normalized_artist}"
+
+
+def _resolve_uncached_song(cache_key, song_title, artist_name, access_token, market):
+  track = get_song_details_from_spotify(song_title, artist_name, access_token=access_token, market=market)
+  track_cache.set(cache_key, track)
+  _count_resolutions('search', [track])
+  return track
+
+
+def _count_resolutions(source, tracks):
+  tracks = list(tracks)
+  found = sum(1 for track in tracks if track)
+  track_resolutions_total.inc(source, 'found', amount=found)
+  track_resolutions_total.inc(source, 'missing', amount=len(tracks) - found)
+
+
+def resolve_song_map(song_artist_pairs, access_token, market=DEFAULT_MARKET):
+  """
+  Resolve (title, artist) pairs to Spotify tracks with at most one search per distinct pair,
+  answering from the track cache where possible. Returns {song key: track or None}.
+  """
+  unique_pairs = {}
+  for song_title, artist_name in song_artist_pairs:
+    unique_pairs.setdefault(_song_cache_key(song_title, artist_name, market), (song_title, artist_name))
+
+  resolved = track_cache.get_many(unique_pairs)
+  _count_resolutions('cache', resolved.values())
+  missing = [key for key in unique_pairs if key not in resolved]
+  if missing:
+    results = bounded_map(
+      lambda key: get_song_details_from_spotify(*unique_pairs[key], access_token=access_token, market=market),
+      missing, user_key=access_token, pool='resolve')
+    fetched = dict(zip(missing, results))
+    track_cache.set_many(fetched)
+    _count_resolutions('search', fetched.values())
+    resolved.update(fetched)
+  return resolved
+
+
+def select_resolved_tracks(song_artist_pairs, resolved, market=DEFAULT_MARKET):
+  """The distinct tracks found for the pairs in a resolve_song_map result, in suggestion order."""
+  tracks = []
+  seen_ids = set()
+  for song_title, artist_name in song_artist_pairs:
+    track = resolved.get(_song_cache_key(song_title, artist_name, market))
+    if track and track['id'] not in seen_ids:
+      seen_ids.add(track['id'])
+      tracks.append(track)
+  return tracks
+
+
+def resolve_songs(song_artist_pairs, access_token, market=DEFAULT_MARKET):
+  """Resolve pairs with resolve_song_map; returns the track objects and their IDs, both in suggestion order."""
+  song_artist_pairs = list(song_artist_pairs)
+  tracks = select_resolved_tracks(song_artist_pairs, resolve_song_map(song_artist_pairs, access_token, market),
+                                  market)
+  return tracks, [track['id'] for track in tracks]
+
+
+def stream_resolved_songs(song_artist_pairs, tokens, market=DEFAULT_MARKET):
+  """
+  Resolve pairs from an iterable that may still be producing them, such as a streaming
+  completion, and yield each distinct track as soon as its search finishes. tokens is called
+  for the access token at each search, so a long stream keeps a fresh one (see SessionTokens).
+  """
+  results = queue.Queue()
+  stop = threading.Event()
+  user_key = tokens()
+
+  def produce():
+    submitted = 0
+    error = None
+    seen_keys = set()
+    try:
+      for song_title, artist_name in song_artist_pairs:
+        if stop.is_set():
+          break
+        key = _song_cache_key(song_title, artist_name, market)
+        if key in seen_keys:
+          continue
+        seen_keys.add(key)
+        submitted += 1
+        cached = track_cache.get(key)
+        if cached is not MISSING:
+          _count_resolutions('cache', [cached])
+          results.put(cached)
+          continue
+        future = submit_bounded(_resolve_uncached_song, key, song_title, artist_name, tokens(), market,
+                                user_key=user_key, pool='resolve')
+        future.add_done_callback(results.put)
+    except Exception as exception:
+      error = exception
+    results.put((_STREAM_DONE, submitted, error))
+
+  producer = copy_current_request_context(produce) if has_request_context() else produce
+  threading.Thread(target=producer, daemon=True).start()
+
+  expected = None
+  received = 0
+  seen_ids = set()
+  try:
+    while expected is None or received < expected:
+      item = results.get()
+      if isinstance(item, tuple) and item[0] is _STREAM_DONE:
+        _, expected, error = item
+        if error is not None:
+          raise error
+        continue
+      received += 1
+      if isinstance(item, Future):
+        if item.exception() is not None:
+          print("Error resolving song:", item.exception())
+          continue
+        item = item.result()
+      if item and item['id'] not in seen_ids:
+        seen_ids.add(item['id'])
+        yield item
+  finally:
+    stop.set()
 
 
 def merge_songs(openai_songs, spotify_songs):
@@ -300,15 +756,7 @@ def merge_songs(openai_songs, spotify_songs):
 
 
 def filter_songs_by_artist_gender(songs, gender):
-  filtered_songs = []
-  for song in songs:
-    artist_id = song["artists"][0]["id"]
-    artist_details = get_artist_details(artist_id)
-    if gender == "male" and artist_details["gender"] == "male":
-      filtered_songs.append(song)
-    elif gender == "female" and artist_details["gender"] == "female":
-      filtered_songs.append(song)
-  return filtered_songs
+  return filter_songs_by_gender(songs, gender)
 
 
 def get_artist_details(artist_id):
@@ -321,6 +769,83 @@ def get_available_genres_from_spotify(access_token):
     response = make_spotify_request('recommendations/available-genre-seeds', headers=headers)
     return response.get('genres', [])
 
+
+def _fetch_genre_seeds(access_token):
+    def fetch():
+        genres = get_available_genres_from_spotify(access_token)
+        record = {"genres": genres, "etag": _genres_etag(genres), "fetched_at": time.time()}
+        genre_seed_cache.set(GENRE_SEEDS_KEY, record)
+        return record
+    return _genre_seed_fetches.do(GENRE_SEEDS_KEY, fetch)
+
+
+def _genres_etag(genres):
+    return hashlib.sha1(json.dumps(genres, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def _refresh_genre_seeds(access_token):
+    try:
+        record = genre_seed_cache.get(GENRE_SEEDS_KEY)
+        if record is MISSING or time.time() - record["fetched_at"] >= GENRE_SEEDS_REFRESH_INTERVAL:
+            _fetch_genre_seeds(access_token)
+    except Exception as error:
+        print("Error refreshing genre seeds:", error)
+
+
+def get_genre_seeds(access_token):
+    """
+    The genre seed list and its ETag, shared by every user. Spotify is only asked when no
+    list is cached; a list older than GENRE_SEEDS_REFRESH_INTERVAL is served while a
+    background refresh replaces it.
+    """
+    record = genre_seed_cache.get(GENRE_SEEDS_KEY)
+    if record is MISSING:
+        record = _fetch_genre_seeds(access_token)
+    elif time.time() - record["fetched_at"] >= GENRE_SEEDS_REFRESH_INTERVAL:
+        get_executor('genre_seeds', max_workers=1).submit(_refresh_genre_seeds, access_token)
+    return record["genres"], record["etag"]
+
+
+def valid_genre_seeds(genres, access_token):
+    """The genres Spotify accepts as seeds, normalized to seed form ('Hip Hop' -> 'hip-hop'), in order."""
+    if not genres:
+        return []
+    known = set(get_genre_seeds(access_token)[0])
+    valid = []
+    for genre in genres:
+        seed = "-".join(str(genre).casefold().split())
+        if seed in known and seed not in valid:
+            valid.append(seed)
+    return valid
+
+
+def get_app_access_token():
+  """An app-only token from the client credentials flow, or None without credentials."""
+  client_id, client_secret = client_credentials()
+  if not client_id or not client_secret:
+    return None
+  headers = {"Authorization": f"Basic {_basic_auth_header()}"}
+  response = services.get('spotify_accounts').request("POST", "api/token", headers=headers,
+                                                      data={'grant_type': 'client_credentials'})
+  if response.status_code != 200:
+    return None
+  return response.json().get('access_token')
+
+
+def prime_caches():
+    """
+    Load the artist and candidate indexes from SQLite and make sure a genre seed list is
+    cached, so the first requests to need them do not pay for it. A missing or stale seed
+    list is fetched with an app token.
+    """
+    len(artist_index)
+    len(candidate_index)
+    record = genre_seed_cache.get(GENRE_SEEDS_KEY)
+    if record is MISSING or time.time() - record["fetched_at"] >= GENRE_SEEDS_REFRESH_INTERVAL:
+        access_token = get_app_access_token()
+        if access_token:
+            _refresh_genre_seeds(access_token)
+
 # def get_artist_gender(artist_id: str, spotify_access_token: str) -> Dict:
 #     # Define headers for Spotify and MusicBrainz requests
 #     spotify_headers = {
@@ -0,0 +1,35 @@
+import os
+import sqlite3
+import threading
+from typing import Iterable
+
+
+class SqliteConnections:
+    """
+    Call for this thread's connection to a SQLite file in WAL mode. Connections are kept per
+    thread and per process, so a forked worker never reuses its parent's, and the schema
+    statements run once, on the first connection.
+    """
+
+    def __init__(self, path: str, schema: Iterable[str] = ()):
+        self.path = path
+        self.schema = list(schema)
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def __call__(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        if not self._schema_ready:
+            with self._schema_lock:
+                if not self._schema_ready:
+                    for statement in self.schema:
+                        connection.execute(statement)
+                    self._schema_ready = True
+        return connection
@@ -0,0 +1,65 @@
+from typing import Dict, List, Optional, Sequence
+
+# Album art size the frontend renders; the image closest to it is the only one kept
+TRACK_IMAGE_SIZE = 300
+# What the frontend renders for a song, used when a request names no fields
+DEFAULT_TRACK_FIELDS = ('id', 'name', 'uri', 'artists', 'album', 'duration_ms', 'preview_url', 'external_urls')
+DEFAULT_PLAYLIST_FIELDS = ('id', 'name', 'uri', 'snapshot_id', 'public', 'external_urls')
+ALL_FIELDS = ('*', 'all')
+
+
+def _pick_image(images) -> List[Dict]:
+    images = [image for image in images or [] if image and image.get('url')]
+    if not images:
+        return []
+    best = min(images, key=lambda image: abs((image.get('width') or TRACK_IMAGE_SIZE) - TRACK_IMAGE_SIZE))
+    return [{"url": best['url'], "width": best.get('width'), "height": best.get('height')}]
+
+
+def compact_track(track: Optional[Dict]) -> Optional[Dict]:
+    """
+    The parts of a Spotify track object the service uses. Search and recommendation results
+    are reduced to this as soon as they arrive, dropping market lists, extra images and
+    links, so caches, the candidate index and responses all carry the compact form. None and
+    id-less tracks pass through.
+    """
+    if not track or not track.get('id'):
+        return track
+    album = track.get('album')
+    if isinstance(album, dict):
+        album = {"id": album.get('id'), "name": album.get('name'), "release_date": album.get('release_date'),
+                 "images": _pick_image(album.get('images'))}
+    external_urls = track.get('external_urls') or {}
+    return {
+        "id": track['id'],
+        "name": track.get('name'),
+        "uri": track.get('uri'),
+        "artists": [{"id": artist.get('id'), "name": artist.get('name')} for artist in track.get('artists') or []],
+        "album": album,
+        "duration_ms": track.get('duration_ms'),
+        "popularity": track.get('popularity'),
+        "explicit": track.get('explicit'),
+        "preview_url": track.get('preview_url'),
+        "external_urls": {"spotify": external_urls['spotify']} if external_urls.get('spotify') else None,
+    }
+
+
+def requested_fields(value, default: Sequence[str]) -> Optional[List[str]]:
+    """
+    The fields a request asked for, as a comma-separated string or a list; None means every
+    field ('*' or 'all'), and a missing or empty value means default.
+    """
+    if isinstance(value, str):
+        value = value.split(',')
+    fields = [field.strip() for field in value or [] if isinstance(field, str) and field.strip()]
+    if not fields:
+        return list(default)
+    if any(field in ALL_FIELDS for field in fields):
+        return None
+    return fields
+
+
+def project(item: Dict, fields: Optional[Sequence[str]]) -> Dict:
+    if fields is None:
+        return item
+    return {field: item[field] for field in fields if field in item}
@@ -0,0 +1,174 @@
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from .services.sqlite import SqliteConnections
+
+
+class MemorySessionStore:
+    """Process-local store, for tests and single-process development."""
+
+    def __init__(self):
+        self._sessions: Dict[str, Tuple[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, sid: str) -> Optional[Tuple[str, float]]:
+        with self._lock:
+            row = self._sessions.get(sid)
+        if row is None or row[1] <= time.time():
+            return None
+        return row
+
+    def set(self, sid: str, data: str, expires_at: float):
+        with self._lock:
+            self._sessions[sid] = (data, expires_at)
+
+    def delete(self, sid: str):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            for sid in [sid for sid, row in self._sessions.items() if row[1] <= now]:
+                del self._sessions[sid]
+
+
+class SqliteSessionStore:
+    """Embedded SQLite store in WAL mode, shared by every worker process on the host."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = SqliteConnections(path, [
+            "CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)"])
+
+    def get(self, sid: str) -> Optional[Tuple[str, float]]:
+        return self._connection().execute(
+            "SELECT data, expires_at FROM sessions WHERE sid = ? AND expires_at > ?", (sid, time.time())).fetchone()
+
+    def set(self, sid: str, data: str, expires_at: float):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO sessions (sid, data, expires_at) VALUES (?, ?, ?)", (sid, data, expires_at))
+
+    def delete(self, sid: str):
+        self._connection().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def purge_expired(self):
+        self._connection().execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),))
+
+
+class StoreSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid: Optional[str] = None, new: bool = False, expires_at: float = 0.0):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.expires_at = expires_at
+        self.modified = False
+
+
+class StoreSessionInterface(SessionInterface):
+    """
+    Server-side sessions in a SessionStore, keyed by a random ID in the session cookie.
+    Sessions are serialized with Flask's tagged JSON and only written back when they changed
+    or when more than half of their lifetime has passed.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, sweep_interval: Optional[float] = None):
+        self.store = store
+        self.sweep_interval = sweep_interval
+        self._sweeper_pid = None
+        self._sweeper_lock = threading.Lock()
+
+    def start_sweeper(self):
+        """Purge expired sessions every sweep_interval on a daemon thread, once per process."""
+        if not self.sweep_interval:
+            return
+        with self._sweeper_lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        threading.Thread(target=self._sweep, args=(self.sweep_interval,), daemon=True,
+                         name='sp-session-sweep').start()
+
+    def _sweep(self, interval: float):
+        while True:
+            time.sleep(interval)
+            try:
+                self.store.purge_expired()
+            except Exception as error:
+                print("Error sweeping expired sessions:", error)
+
+    def load_session_data(self, sid: str) -> Optional[Dict]:
+        """A stored session's data, for work that outlives the request that saved it."""
+        row = self.store.get(sid)
+        return self.serializer.loads(row[0]) if row is not None else None
+
+    def update_session_data(self, sid: str, values: Dict) -> bool:
+        """Merge values into a stored session, keeping its expiry. Returns whether the session was still stored."""
+        row = self.store.get(sid)
+        if row is None:
+            return False
+        data = self.serializer.loads(row[0])
+        data.update(values)
+        self.store.set(sid, self.serializer.dumps(data), row[1])
+        return True
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            row = self.store.get(sid)
+            if row is not None:
+                return StoreSession(self.serializer.loads(row[0]), sid=sid, expires_at=row[1])
+        return StoreSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        stale = session.expires_at - time.time() < lifetime / 2
+        if not (session.modified or session.new or stale):
+            return
+
+        expires_at = time.time() + lifetime
+        self.store.set(session.sid, self.serializer.dumps(dict(session)), expires_at)
+        permanent = app.config.get('SESSION_PERMANENT', True)
+        response.set_cookie(name, session.sid,
+                            expires=datetime.fromtimestamp(expires_at, timezone.utc) if permanent else None,
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain,
+                            path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+
+def create_session_interface(config) -> Optional[StoreSessionInterface]:
+    """The interface for SESSION_TYPE 'sqlite' or 'memory', or None for other Flask-Session types."""
+    session_type = config.get('SESSION_TYPE')
+    if session_type == 'sqlite':
+        store = SqliteSessionStore(config.get('SESSION_SQLITE_PATH', 'sessions.sqlite3'))
+    elif session_type == 'memory':
+        store = MemorySessionStore()
+    else:
+        return None
+    return StoreSessionInterface(store, sweep_interval=config.get('SESSION_SWEEP_INTERVAL'))
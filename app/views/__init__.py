@@ -1,2 +1,4 @@
 from .authorization import auth_blueprint
+from .jobs import jobs_blueprint
+from .metrics import metrics_blueprint
 from .spotify import spotify_blueprint
@@ -1,14 +1,10 @@
-from os import environ
-
 from flask import Blueprint, session, request, redirect, jsonify
 
-from ..services.spotify import get_spotify_auth
+from ..services.spotify import BASE_SPOTIFY_ACCOUNTS_URL, REDIRECT_URI, client_credentials, get_spotify_auth, \
+    store_session_tokens
 
 BASE_FLASK_URI = 'http://127.0.0.1:8080'
 BASE_URI = 'http://127.0.0.1:5173'
-CLIENT_ID = environ.get('CLIENT_ID')
-CLIENT_SECRET = environ.get('CLIENT_SECRET')
-REDIRECT_URI = f'{BASE_FLASK_URI}/callback'
 
 auth_blueprint = Blueprint('auth', __name__)
 
@@ -25,9 +21,9 @@ def index():
     refresh_token = session.get('refresh_token')
     # if access_token and refresh_token:
     #     return redirect_to_app()
-    auth_url = "https://accounts.spotify.com/authorize"
+    auth_url = f"{BASE_SPOTIFY_ACCOUNTS_URL}authorize"
     params = {
-        "client_id": CLIENT_ID,
+        "client_id": client_credentials()[0],
         "response_type": "code",
         "redirect_uri": REDIRECT_URI,
         "scope": "playlist-modify-private"
@@ -39,9 +35,9 @@ def index():
 @auth_blueprint.route('/callback')
 def callback():
     code = request.args.get('code')
-    [access_token, refresh_token] = get_spotify_auth(code)
-    session['access_token'] = access_token
-    session['refresh_token'] = refresh_token
+    [access_token, refresh_token, expires_in] = get_spotify_auth(code)
+    store_session_tokens(access_token, refresh_token, expires_in)
+    session.pop('user_id', None)
     if access_token:
         return redirect_to_app()
     return "Failed to retrieve access token", 400
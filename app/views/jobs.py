@@ -0,0 +1,46 @@
+from flask import Blueprint, request, jsonify, session, url_for
+
+from ..services.jobs import job_manager
+from ..services.pipeline import generate_songs, song_request_from_json
+from ..services.spotify import SessionTokens, ensure_fresh_access_token, get_session_user_id
+
+jobs_blueprint = Blueprint('jobs', __name__)
+
+
+@jobs_blueprint.before_request
+def refresh_expiring_access_token():
+    ensure_fresh_access_token()
+
+
+@jobs_blueprint.route('/jobs/search-songs', methods=['POST'])
+def create_search_songs_job():
+    song_request = song_request_from_json(request.json)
+    access_token = session.get('access_token')
+    owner = get_session_user_id(access_token)
+
+    # The job outlives this request, so it refreshes tokens into the session store itself
+    tokens = SessionTokens.from_session()
+
+    job = job_manager.submit(owner, lambda job: generate_songs(song_request, tokens,
+                                                               on_progress=job.progress,
+                                                               is_cancelled=job.is_cancelled,
+                                                               deadline=job.deadline))
+    response = jsonify(job)
+    response.headers['Location'] = url_for('jobs.get_job', job_id=job['jobId'])
+    return response, 202
+
+
+@jobs_blueprint.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id, session.get('user_id'))
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+
+@jobs_blueprint.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job = job_manager.cancel(job_id, session.get('user_id'))
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
@@ -0,0 +1,42 @@
+import time
+
+from flask import Blueprint, Response, current_app, g, jsonify, request
+
+from ..services.metrics import http_request_seconds, registry, server_timing_header
+from ..warmup import warm_up_state
+
+metrics_blueprint = Blueprint('metrics', __name__)
+
+
+@metrics_blueprint.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@metrics_blueprint.after_app_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    http_request_seconds.observe(time.perf_counter() - started, endpoint, request.method, response.status_code)
+    # Cumulative time per upstream and per pipeline stage; parallel calls add up past wall time
+    if current_app.config.get('SERVER_TIMING_HEADER') or request.headers.get('X-Server-Timing'):
+        timing = server_timing_header()
+        if timing:
+            response.headers['Server-Timing'] = timing
+    return response
+
+
+@metrics_blueprint.route('/metrics')
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@metrics_blueprint.route('/ready')
+def ready():
+    # Apps created without WARM_UP_ON_START have nothing to wait for
+    if not current_app.config.get('WARM_UP_ON_START'):
+        return jsonify({"ready": True})
+    state = warm_up_state(current_app)
+    return jsonify(state), 200 if state["ready"] else 503
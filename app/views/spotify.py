@@ -1,67 +1,127 @@
-from flask import Blueprint, request, jsonify, session
+import json
+import os
 
-from ..services.openai_service import (ask_openai_for_songs, parse_openai_response,
-                                       ask_openai_to_classify_gender_and_filter_songs)
-from ..services.spotify import get_user_id, create_playlist, add_tracks_to_playlist, get_spotify_track_ids, \
-    get_audio_features, search_artists, get_recommendations_based_on_features, \
-    get_artist_ids_from_names, merge_songs, get_song_details_from_spotify, get_available_genres_from_spotify
+from flask import Blueprint, Response, g, request, jsonify, session, stream_with_context
+
+from ..services.openai_service import stream_openai_song_pairs
+from ..services.pipeline import generate_songs, generate_songs_batch, get_matching_songs, song_request_from_json
+from ..services.tracks import DEFAULT_PLAYLIST_FIELDS, DEFAULT_TRACK_FIELDS, project, requested_fields
+from ..services.spotify import get_session_user_id, create_playlist, add_tracks_to_playlist, \
+    stream_resolved_songs, suggest_artists, get_genre_seeds, ensure_fresh_access_token, SessionTokens
+
+GENRES_MAX_AGE = 3600
+BATCH_MAX_SPECS = int(os.environ.get('SEARCH_SONGS_BATCH_MAX_SPECS', 10))
 
 spotify_blueprint = Blueprint('spotify', __name__)
 
 
+def _requested_fields(default):
+    # ?fields=id,name,... or a "fields" list in the JSON body; '*' returns everything
+    body = request.get_json(silent=True) if request.is_json else None
+    return requested_fields(request.args.get('fields') or (body or {}).get('fields'), default)
+
+
+def _project_songs(songs, fields):
+    return [project(song, fields) for song in songs]
+
+
+@spotify_blueprint.before_request
+def refresh_expiring_access_token():
+    ensure_fresh_access_token()
+
+
 @spotify_blueprint.route('/create-playlist', methods=['POST'])
 def create_playlist_endpoint():
     data = request.json
     song_ids = data.get('songs', [])
     playlist_name = data.get('name', 'My Playlist')
     access_token = session.get('access_token')
-    user_id = get_user_id(access_token)
+    user_id = get_session_user_id(access_token)
     playlist = create_playlist(access_token, user_id, playlist_name)
-    add_tracks_to_playlist(access_token, playlist["id"], song_ids)
-    return jsonify(playlist)
+    if song_ids:
+        snapshot = add_tracks_to_playlist(access_token, playlist["id"], song_ids)
+        playlist["snapshot_id"] = snapshot.get("snapshot_id", playlist.get("snapshot_id"))
+    return jsonify(project(playlist, _requested_fields(DEFAULT_PLAYLIST_FIELDS)))
 
 
 @spotify_blueprint.route('/search-songs', methods=['POST'])
 def search_songs():
-    data = request.json
-    moods = data.get('moods', [])
-    activities = data.get('activities', [])
-    artists = data.get('artists', [])
-    song_count = data.get('songCount', 10)
-    gender_preference = data.get('genderPreference', None)
+    song_request = song_request_from_json(request.json)
+    combined_songs = generate_songs(song_request, ensure_fresh_access_token)
+
+    return jsonify({"songs": _project_songs(combined_songs, _requested_fields(DEFAULT_TRACK_FIELDS))})
+
+
+@spotify_blueprint.route('/search-songs/batch', methods=['POST'])
+def search_songs_batch():
+    """
+    Several /search-songs requests in one call: {"specs": [...]} with one /search-songs body
+    per playlist; returns {"results": [{"songs": [...]}, ...]} in the same order.
+    """
+    specs = (request.json or {}).get('specs')
+    if not isinstance(specs, list) or not specs or not all(isinstance(spec, dict) for spec in specs):
+        return jsonify({"error": "specs must be a non-empty list of song requests"}), 400
+    if len(specs) > BATCH_MAX_SPECS:
+        return jsonify({"error": f"At most {BATCH_MAX_SPECS} specs per batch"}), 400
     access_token = session.get("access_token")
 
-    # 1. Use OpenAI to get song suggestions based on moods, activities, and artists
-    openai_response = ask_openai_for_songs(moods, activities, artists, song_count, None, gender_preference)
-
-    # 2. Parse the OpenAI response to get song titles and artists
-    song_artist_pairs = parse_openai_response(openai_response)
-
-    song_titles = [pair[0] for pair in song_artist_pairs]
-    suggested_artists = [pair[1] for pair in song_artist_pairs]
-
-    openai_songs_spotify_details = []
-    for song, artist in song_artist_pairs:
-        song_details = get_song_details_from_spotify(song, artist)
-        if song_details:
-            openai_songs_spotify_details.append(song_details)
-
-    # Get Spotify track IDs using the song titles and artists
-    track_ids = get_spotify_track_ids(song_titles, suggested_artists, access_token)
-
-    # Extract artist IDs from the songs recommended by OpenAI
-    artist_ids = get_artist_ids_from_names(artists, access_token)
-
-    # Now, pass artist_ids and track_ids as seed_artists and seed_tracks to the function
-    audio_features = get_audio_features(track_ids, access_token)
-    matching_songs = get_recommendations_based_on_features(audio_features, artist_ids, track_ids, access_token,
-                                                           song_count)
-    if gender_preference is not None:
-        matching_songs = ask_openai_to_classify_gender_and_filter_songs(matching_songs, gender_preference)
-
-    combined_songs = merge_songs(openai_songs_spotify_details, matching_songs)
-
-    return jsonify({"songs": combined_songs})
+    results = generate_songs_batch([song_request_from_json(spec) for spec in specs], access_token)
+
+    fields = _requested_fields(DEFAULT_TRACK_FIELDS)
+    return jsonify({"results": [{"songs": _project_songs(songs, fields)} for songs in results]})
+
+
+def _format_stream_event(event, server_sent_events):
+    payload = json.dumps(event, separators=(',', ':'))
+    if server_sent_events:
+        return f"event: {event['type']}\ndata: {payload}\n\n"
+    return payload + "\n"
+
+
+@spotify_blueprint.route('/search-songs/stream', methods=['POST'])
+def search_songs_stream():
+    """
+    Streaming variant of /search-songs: songs are resolved while the completion is still
+    being generated and sent as NDJSON lines, or as Server-Sent Events when requested.
+    """
+    song_request = song_request_from_json(request.json)
+    # The session is saved before the body streams, so tokens refreshed while streaming go to the store
+    tokens = g.session_tokens = SessionTokens.from_session()
+    server_sent_events = ('text/event-stream' in request.headers.get('Accept', '')
+                          or request.args.get('format') == 'sse')
+    fields = _requested_fields(DEFAULT_TRACK_FIELDS)
+
+    def generate():
+        try:
+            pairs = stream_openai_song_pairs(song_request['moods'], song_request['activities'],
+                                             song_request['artists'], song_request['song_count'], None,
+                                             song_request['gender_preference'])
+            openai_songs = []
+            for song in stream_resolved_songs(pairs, tokens):
+                openai_songs.append(song)
+                yield _format_stream_event({"type": "song", "source": "openai", "song": project(song, fields)},
+                                           server_sent_events)
+
+            sent_ids = {song['id'] for song in openai_songs}
+            matching_songs = get_matching_songs(openai_songs, song_request['artists'], song_request['song_count'],
+                                                song_request['gender_preference'], tokens(),
+                                                fan_out=song_request['fan_out'],
+                                                known_artist_ids=song_request['artist_ids'])
+            for song in matching_songs:
+                if song['id'] not in sent_ids:
+                    sent_ids.add(song['id'])
+                    yield _format_stream_event({"type": "song", "source": "recommendations",
+                                                "song": project(song, fields)}, server_sent_events)
+            yield _format_stream_event({"type": "done", "count": len(sent_ids)}, server_sent_events)
+        except Exception as error:
+            print("Error streaming songs:", error)
+            yield _format_stream_event({"type": "error", "error": str(error)}, server_sent_events)
+
+    mimetype = 'text/event-stream' if server_sent_events else 'application/x-ndjson'
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @spotify_blueprint.route('/search-artists')
@@ -70,7 +130,7 @@ def search_artists_endpoint():
     if not query:
         return jsonify({"error": "Query parameter is required"}), 400
     access_token = session.get('access_token')
-    artists = search_artists(query, access_token)
+    artists = suggest_artists(query, access_token)
     if artists:
         return jsonify({"artists": artists})
     else:
@@ -80,5 +140,10 @@ def search_artists_endpoint():
 @spotify_blueprint.route('/available-genres', methods=['GET'])
 def available_genres():
     access_token = session.get('access_token')
-    genres = get_available_genres_from_spotify(access_token)
-    return jsonify(genres)
+    genres, etag = get_genre_seeds(access_token)
+    response = jsonify(genres)
+    # The list is identical for every user, so any cache may keep it; clients revalidate with If-None-Match
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = GENRES_MAX_AGE
+    return response.make_conditional(request)
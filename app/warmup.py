@@ -0,0 +1,72 @@
+import os
+import threading
+import time
+
+from flask import current_app
+
+from .services.cache import sweep_caches
+from .services.registry import services
+from .services.spotify import prime_caches
+
+_started_lock = threading.Lock()
+
+
+def warm_up(app):
+    """
+    Build the upstream clients and open their connection pools, load the artist and
+    candidate indexes and make sure a genre seed list is cached, then mark this process
+    ready (see /ready). A step that fails is reported and the rest still run.
+    """
+    started = time.perf_counter()
+    outcomes = services.warm_up(app.config.get('WARM_UP_SERVICES'))
+    try:
+        prime_caches()
+        outcomes['caches'] = None
+    except Exception as error:
+        print("Error priming caches:", error)
+        outcomes['caches'] = str(error) or type(error).__name__
+    app.extensions['warm_up'] = {"pid": os.getpid(), "ready": True,
+                                 "seconds": round(time.perf_counter() - started, 3),
+                                 "errors": {name: error for name, error in outcomes.items() if error}}
+    return outcomes
+
+
+def warm_up_state(app) -> dict:
+    """This process's warm-up state; one inherited from a parent process does not count."""
+    state = app.extensions.get('warm_up')
+    if state is None or state["pid"] != os.getpid():
+        return {"ready": False}
+    return state
+
+
+def start_worker(app):
+    """
+    Start this process's background work: the session and cache sweeps and, with
+    WARM_UP_ON_START, the warm-up. Threads and pooled connections do not survive a fork, so this runs once per
+    process, never in create_app. It runs on the first request a process serves; a
+    preloading server should call it from its post-fork hook, e.g. for gunicorn:
+
+        def post_fork(server, worker):
+            from app.warmup import start_worker
+            from main import app
+            start_worker(app)
+    """
+    with _started_lock:
+        if app.extensions.get('worker_pid') == os.getpid():
+            return
+        app.extensions['worker_pid'] = os.getpid()
+        if app.config.get('WARM_UP_ON_START'):
+            app.extensions['warm_up'] = {"pid": os.getpid(), "ready": False}
+    start_sweeper = getattr(app.session_interface, 'start_sweeper', None)
+    if start_sweeper is not None:
+        start_sweeper()
+    if app.config.get('CACHE_SWEEP_INTERVAL'):
+        threading.Thread(target=sweep_caches, args=(app.config['CACHE_SWEEP_INTERVAL'],), daemon=True,
+                         name='sp-cache-sweep').start()
+    if app.config.get('WARM_UP_ON_START'):
+        threading.Thread(target=warm_up, args=(app,), daemon=True, name='sp-warm-up').start()
+
+
+def start_worker_on_first_request():
+    if current_app.extensions.get('worker_pid') != os.getpid():
+        start_worker(current_app._get_current_object())
@@ -0,0 +1,435 @@
+"""
+Local stand-ins for Spotify (API and accounts), MusicBrainz and OpenAI, served from one
+threaded HTTP server under a path prefix per upstream:
+
+    /spotify/v1/    SPOTIFY_API_URL
+    /accounts/      SPOTIFY_ACCOUNTS_URL
+    /musicbrainz/   MUSICBRAINZ_URL
+    /openai/v1      OPENAI_API_BASE
+
+Responses come from a deterministic catalogue, so the same request always gets the same
+answer. Each upstream has a profile of latency, error rate and rate limit; requests over
+the rate limit get a 429 with Retry-After, like the real services.
+
+    python -m bench.fake_upstreams --port 9000 --set spotify_api.latency=0.08
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, fields
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+UPSTREAMS = ('spotify_api', 'spotify_accounts', 'musicbrainz', 'openai')
+_PREFIXES = (('/spotify/v1/', 'spotify_api'), ('/accounts/', 'spotify_accounts'),
+             ('/musicbrainz/', 'musicbrainz'), ('/openai/v1/', 'openai'))
+
+CATALOGUE_ARTISTS = 400
+CATALOGUE_SONGS = 4000
+GENRES = ('acoustic', 'ambient', 'blues', 'classical', 'country', 'dance', 'disco', 'edm', 'folk', 'funk',
+          'hip-hop', 'house', 'indie', 'jazz', 'k-pop', 'latin', 'metal', 'pop', 'punk', 'r-n-b', 'reggae',
+          'rock', 'soul', 'techno')
+
+
+@dataclass
+class UpstreamProfile:
+    latency: float = 0.0  # Seconds added to every response
+    jitter: float = 0.0  # Extra uniform random latency, up to this many seconds
+    error_rate: float = 0.0  # Share of requests answered with a 503
+    rate_limit: float = 0.0  # Requests per second before answering 429; 0 disables the limit
+    retry_after: int = 1  # Retry-After seconds sent with a 429
+    miss_rate: float = 0.0  # Share of track searches that find nothing
+    token_interval: float = 0.0  # Seconds between streamed completion chunks
+
+
+DEFAULT_PROFILES = {
+    'spotify_api': UpstreamProfile(latency=0.04, jitter=0.02, miss_rate=0.05),
+    'spotify_accounts': UpstreamProfile(latency=0.05),
+    'musicbrainz': UpstreamProfile(latency=0.15, jitter=0.05),
+    'openai': UpstreamProfile(latency=0.8, jitter=0.4, token_interval=0.005),
+}
+
+
+def _digest(*parts) -> bytes:
+    return hashlib.sha1('\x1f'.join(str(part) for part in parts).encode('utf-8')).digest()
+
+
+def _fraction(*parts) -> float:
+    return int.from_bytes(_digest(*parts)[:4], 'big') / 2 ** 32
+
+
+def _spotify_id(*parts) -> str:
+    alphabet = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+    number = int.from_bytes(_digest(*parts)[:16], 'big')
+    characters = []
+    for _ in range(22):
+        number, remainder = divmod(number, 62)
+        characters.append(alphabet[remainder])
+    return ''.join(characters)
+
+
+def artist_name(index: int) -> str:
+    return f"Artist {index:03d}"
+
+
+def song(index: int) -> Tuple[str, str]:
+    """The (title, artist) of a catalogue song."""
+    return f"Song {index:04d}", artist_name(index % CATALOGUE_ARTISTS)
+
+
+def _artist(name: str) -> Dict:
+    return {
+        "id": _spotify_id('artist', name),
+        "name": name,
+        "popularity": int(_fraction('popularity', name) * 100),
+        "genres": [GENRES[int(_fraction('genre', name) * len(GENRES))]],
+        "images": [{"url": f"https://i.example/{_spotify_id('image', name)}", "height": 640, "width": 640}],
+        "type": "artist",
+    }
+
+
+def _track(title: str, artist: str) -> Dict:
+    track_id = _spotify_id('track', title.casefold(), artist.casefold())
+    album_id = _spotify_id('album', artist)
+    return {
+        "id": track_id,
+        "name": title,
+        "uri": f"spotify:track:{track_id}",
+        "popularity": int(_fraction('popularity', track_id) * 100),
+        "duration_ms": 120000 + int(_fraction('duration', track_id) * 240000),
+        "explicit": False,
+        "preview_url": None,
+        "external_urls": {"spotify": f"https://open.spotify.com/track/{track_id}"},
+        "available_markets": ["CA", "US", "GB", "DE", "FR", "JP", "BR", "MX"],
+        "album": {
+            "id": album_id,
+            "name": f"{artist} Collection",
+            "release_date": "2015-01-01",
+            "images": [{"url": f"https://i.example/{album_id}", "height": 640, "width": 640}],
+            "available_markets": ["CA", "US", "GB", "DE", "FR", "JP", "BR", "MX"],
+        },
+        "artists": [{"id": _spotify_id('artist', artist), "name": artist}],
+        "type": "track",
+    }
+
+
+def _audio_features(track_id: str) -> Dict:
+    def value(name, low=0.0, high=1.0):
+        return round(low + _fraction(name, track_id) * (high - low), 4)
+
+    return {
+        "id": track_id,
+        "acousticness": value('acousticness'),
+        "danceability": value('danceability'),
+        "duration_ms": 120000 + int(_fraction('duration', track_id) * 240000),
+        "energy": value('energy'),
+        "instrumentalness": value('instrumentalness', 0, 0.3),
+        "key": int(_fraction('key', track_id) * 12),
+        "liveness": value('liveness', 0, 0.5),
+        "loudness": value('loudness', -20, -2),
+        "mode": int(_fraction('mode', track_id) * 2),
+        "speechiness": value('speechiness', 0, 0.4),
+        "tempo": value('tempo', 60, 190),
+        "time_signature": 4,
+        "valence": value('valence'),
+        "type": "audio_features",
+    }
+
+
+def _suggested_songs(prompt: str) -> List[Tuple[str, str]]:
+    match = re.search(r'exactly (\d+) number of songs', prompt)
+    count = int(match.group(1)) if match else 10
+    rng = random.Random(_digest('prompt', prompt))
+    indexes = rng.sample(range(CATALOGUE_SONGS), min(count, CATALOGUE_SONGS))
+    return [song(index) for index in indexes]
+
+
+def _completion_text(prompt: str) -> str:
+    lines = [f'{number}. "{title}" by "{artist}"'
+             for number, (title, artist) in enumerate(_suggested_songs(prompt), start=1)]
+    return "Here are some songs you might enjoy:\n\n" + "\n".join(lines)
+
+
+class _RateLimiter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens: Dict[str, float] = {}
+        self._updated: Dict[str, float] = {}
+
+    def allow(self, upstream: str, rate: float) -> bool:
+        if rate <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._updated.get(upstream, now)
+            tokens = min(rate, self._tokens.get(upstream, rate) + elapsed * rate)
+            self._updated[upstream] = now
+            if tokens < 1:
+                self._tokens[upstream] = tokens
+                return False
+            self._tokens[upstream] = tokens - 1
+            return True
+
+
+def _search_field(q: str, field: str) -> str:
+    """The value of one field filter in a Spotify search query, e.g. track:"Song 12"; quoted or one word."""
+    match = re.search(rf'(?:^|\s){field}:(?:"([^"]*)"|(\S+))', q)
+    if match is None:
+        return ''
+    return (match.group(1) if match.group(1) is not None else match.group(2)).strip()
+
+
+class FakeUpstreams:
+    """The stand-in server; start() runs it on a daemon thread and returns the base URLs."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0,
+                 profiles: Optional[Dict[str, UpstreamProfile]] = None, seed: int = 0):
+        self.profiles = {name: UpstreamProfile(**vars(profile)) for name, profile in DEFAULT_PROFILES.items()}
+        self.profiles.update(profiles or {})
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._limiter = _RateLimiter()
+        self._counts_lock = threading.Lock()
+        self.counts: Dict[Tuple[str, int], int] = {}
+        self._token_counter = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def environment(self) -> Dict[str, str]:
+        """Environment variables that point the app at these stand-ins."""
+        return {
+            'SPOTIFY_API_URL': f"{self.base_url}/spotify/v1/",
+            'SPOTIFY_ACCOUNTS_URL': f"{self.base_url}/accounts/",
+            'MUSICBRAINZ_URL': f"{self.base_url}/musicbrainz/",
+            'OPENAI_API_BASE': f"{self.base_url}/openai/v1",
+            'OPENAI_KEY': 'bench',
+            'CLIENT_ID': 'bench',
+            'CLIENT_SECRET': 'bench',
+        }
+
+    def start(self) -> Dict[str, str]:
+        threading.Thread(target=self.server.serve_forever, daemon=True, name='fake-upstreams').start()
+        return self.environment()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def call_counts(self) -> Dict[str, Dict[str, int]]:
+        counts: Dict[str, Dict[str, int]] = {}
+        with self._counts_lock:
+            for (upstream, status), count in sorted(self.counts.items()):
+                counts.setdefault(upstream, {})[str(status)] = count
+        return counts
+
+    def _count(self, upstream: str, status: int):
+        with self._counts_lock:
+            self.counts[(upstream, status)] = self.counts.get((upstream, status), 0) + 1
+
+    def _chance(self) -> float:
+        with self._random_lock:
+            return self._random.random()
+
+    def _handler_class(self):
+        upstreams = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                upstreams._handle(self)
+
+            def do_POST(self):
+                upstreams._handle(self)
+
+            def do_PUT(self):
+                upstreams._handle(self)
+
+        return Handler
+
+    def _handle(self, handler: BaseHTTPRequestHandler):
+        url = urlsplit(handler.path)
+        length = int(handler.headers.get('Content-Length') or 0)
+        raw_body = handler.rfile.read(length) if length else b''
+        for prefix, upstream in _PREFIXES:
+            if url.path.startswith(prefix):
+                break
+        else:
+            return self._send_json(handler, 'unknown', 404, {"error": "unknown upstream"})
+
+        profile = self.profiles[upstream]
+        delay = profile.latency + profile.jitter * self._chance()
+        if delay:
+            time.sleep(delay)
+        if not self._limiter.allow(upstream, profile.rate_limit):
+            return self._send_json(handler, upstream, 429, {"error": {"status": 429, "message": "rate limited"}},
+                                   headers={'Retry-After': str(profile.retry_after)})
+        if profile.error_rate and self._chance() < profile.error_rate:
+            return self._send_json(handler, upstream, 503, {"error": {"status": 503, "message": "unavailable"}})
+
+        path = url.path[len(prefix):]
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        content_type = handler.headers.get('Content-Type', '')
+        if 'application/json' in content_type and raw_body:
+            body = json.loads(raw_body)
+        else:
+            body = {key: values[0] for key, values in parse_qs(raw_body.decode('utf-8')).items()}
+        route = getattr(self, f"_{upstream}")
+        result = route(handler, handler.command, path, query, body, profile)
+        if result is not None:
+            status, payload = result
+            self._send_json(handler, upstream, status, payload)
+
+    def _send_json(self, handler, upstream: str, status: int, payload, headers: Optional[Dict[str, str]] = None):
+        data = json.dumps(payload).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+        self._count(upstream, status)
+
+    def _spotify_api(self, handler, method, path, query, body, profile):
+        if path == 'search' and query.get('type') == 'track':
+            title, artist = _search_field(query.get('q', ''), 'track'), _search_field(query.get('q', ''), 'artist')
+            found = _fraction('miss', title.casefold()) >= profile.miss_rate
+            return 200, {"tracks": {"items": [_track(title, artist)] if found and title else []}}
+        if path == 'search' and query.get('type') == 'artist':
+            term = query.get('q', '').casefold()
+            limit = int(query.get('limit', 20))
+            names = [artist_name(index) for index in range(CATALOGUE_ARTISTS)]
+            matches = [name for name in names if term in name.casefold()] or [term.title()]
+            return 200, {"artists": {"items": [_artist(name) for name in matches[:limit]]}}
+        if path == 'audio-features':
+            ids = [track_id for track_id in query.get('ids', '').split(',') if track_id]
+            return 200, {"audio_features": [_audio_features(track_id) for track_id in ids]}
+        if path == 'recommendations/available-genre-seeds':
+            return 200, {"genres": list(GENRES)}
+        if path == 'recommendations':
+            limit = int(query.get('limit', 20))
+            rng = random.Random(_digest('recommendations', sorted(query.items())))
+            return 200, {"tracks": [_track(*song(index)) for index in rng.sample(range(CATALOGUE_SONGS), limit)]}
+        if path == 'me':
+            token = handler.headers.get('Authorization', '')
+            return 200, {"id": 'user-' + _spotify_id('user', token)[:10]}
+        match = re.fullmatch(r'users/([^/]+)/playlists', path)
+        if match and method == 'POST':
+            playlist_id = _spotify_id('playlist', match.group(1), body.get('name'), time.time())
+            return 201, {"id": playlist_id, "name": body.get('name'), "public": body.get('public', False),
+                         "snapshot_id": _spotify_id('snapshot', playlist_id, 0)}
+        match = re.fullmatch(r'playlists/([^/]+)/tracks', path)
+        if match and method == 'POST':
+            return 201, {"snapshot_id": _spotify_id('snapshot', match.group(1), body.get('uris'))}
+        match = re.fullmatch(r'artists/([^/]+)', path)
+        if match:
+            return 200, _artist(f"Artist {match.group(1)}")
+        return 404, {"error": {"status": 404, "message": "Service not found"}}
+
+    def _spotify_accounts(self, handler, method, path, query, body, profile):
+        if path == 'api/token' and method == 'POST':
+            with self._counts_lock:
+                self._token_counter += 1
+                counter = self._token_counter
+            seed = body.get('code') or body.get('refresh_token') or ''
+            return 200, {"access_token": f"bench-{_spotify_id('token', seed, counter)}",
+                         "refresh_token": body.get('refresh_token') or f"refresh-{_spotify_id('refresh', seed)}",
+                         "token_type": "Bearer", "expires_in": 3600}
+        return 404, {"error": "not_found"}
+
+    def _musicbrainz(self, handler, method, path, query, body, profile):
+        if path.startswith('artist'):
+            names = re.findall(r'artist:"((?:[^"\\]|\\.)*)"', query.get('query', ''))
+            artists = []
+            for name in names:
+                name = name.replace('\\"', '"').replace('\\\\', '\\')
+                gender = ('male', 'female', None)[int(_fraction('gender', name.casefold()) * 3)]
+                artists.append({"id": _spotify_id('mbid', name), "name": name, "score": 100,
+                                "type": "Person" if gender else "Group", "gender": gender, "aliases": []})
+            return 200, {"count": len(artists), "offset": 0, "artists": artists}
+        return 404, {"error": "Not Found"}
+
+    def _openai(self, handler, method, path, query, body, profile):
+        if path != 'chat/completions' or method != 'POST':
+            return 404, {"error": {"message": "Unknown request URL"}}
+        prompt = "\n".join(message.get('content') or '' for message in body.get('messages', []))
+        text = _completion_text(prompt)
+        message = {"role": "assistant", "content": text}
+        if body.get('functions'):
+            songs = [{"title": title, "artist": artist} for title, artist in _suggested_songs(prompt)]
+            message = {"role": "assistant", "content": None,
+                       "function_call": {"name": body['functions'][0]['name'],
+                                         "arguments": json.dumps({"songs": songs})}}
+        if not body.get('stream'):
+            return 200, {
+                "id": "chatcmpl-bench", "object": "chat.completion", "model": body.get('model'),
+                "choices": [{"index": 0, "finish_reason": "stop", "message": message}],
+                "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(text) // 4,
+                          "total_tokens": (len(prompt) + len(text)) // 4},
+            }
+
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+        handler.close_connection = True
+        for start in range(0, len(text), 8):
+            chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "model": body.get('model'),
+                     "choices": [{"index": 0, "delta": {"content": text[start:start + 8]}, "finish_reason": None}]}
+            handler.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+            handler.wfile.flush()
+            if profile.token_interval:
+                time.sleep(profile.token_interval)
+        handler.wfile.write(b"data: [DONE]\n\n")
+        handler.wfile.flush()
+        self._count('openai', 200)
+        return None
+
+
+def parse_profile_overrides(assignments: List[str]) -> Dict[str, UpstreamProfile]:
+    """Apply 'upstream.field=value' assignments, e.g. 'openai.latency=2', to the default profiles."""
+    profiles = {name: UpstreamProfile(**vars(profile)) for name, profile in DEFAULT_PROFILES.items()}
+    types = {profile_field.name: profile_field.type for profile_field in fields(UpstreamProfile)}
+    for assignment in assignments or []:
+        target, _, value = assignment.partition('=')
+        upstream, _, name = target.partition('.')
+        if upstream not in profiles or name not in types:
+            raise ValueError(f"Unknown profile setting: {assignment}")
+        setattr(profiles[upstream], name, int(value) if types[name] in (int, 'int') else float(value))
+    return profiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--set', action='append', default=[], metavar='UPSTREAM.FIELD=VALUE',
+                        help=f"override a profile setting; upstreams: {', '.join(UPSTREAMS)}")
+    args = parser.parse_args()
+
+    upstreams = FakeUpstreams(args.host, args.port, parse_profile_overrides(args.set), seed=args.seed)
+    for name, value in upstreams.environment().items():
+        print(f"export {name}={value}")
+    try:
+        upstreams.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+"""
+Load test for the main endpoints against the local upstream stand-ins.
+
+By default the app is imported and served in-process on a threaded server, with every
+upstream URL pointed at bench.fake_upstreams and the caches and sessions kept in a fresh
+temporary directory, so a run starts cold and needs no network or credentials. Each
+virtual user logs in through /callback to get its own session and access token, then
+issues requests back to back (a closed loop) until the level's request count is reached.
+
+    python -m bench.run --concurrency 1,8,32 --requests 200
+    python -m bench.run --scenarios search-songs --set openai.latency=2 --json before.json
+
+With --target the harness drives an already running server instead; start it with the
+environment printed by `python -m bench.fake_upstreams` so it talks to the stand-ins.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+from .fake_upstreams import CATALOGUE_ARTISTS, CATALOGUE_SONGS, FakeUpstreams, artist_name, \
+    parse_profile_overrides, song
+
+SCENARIOS = ('search-songs', 'search-songs-batch', 'create-playlist', 'search-artists', 'available-genres')
+BATCH_SPECS = 3
+MOODS = ('happy', 'sad', 'energetic', 'calm', 'romantic', 'angry', 'nostalgic', 'dreamy')
+ACTIVITIES = ('running', 'studying', 'cooking', 'driving', 'partying', 'sleeping')
+
+
+class Payloads:
+    """
+    Seeded request payloads. Each scenario draws from a pool of `distinct` payloads, so the
+    share of repeated requests, and with it the cache hit rate, is the same on every run.
+    """
+
+    def __init__(self, seed: int, distinct: int):
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.song_requests = [self._song_request() for _ in range(distinct)]
+        self.playlists = [self._playlist(index) for index in range(distinct)]
+        self.artist_queries = [self._artist_query() for _ in range(distinct)]
+
+    def _song_request(self) -> Dict:
+        return {
+            "moods": self._random.sample(MOODS, 2),
+            "activities": [self._random.choice(ACTIVITIES)],
+            "artists": [artist_name(self._random.randrange(CATALOGUE_ARTISTS)) for _ in range(2)],
+            "songCount": self._random.choice((10, 20, 30)),
+            "genderPreference": self._random.choice((None, None, None, 'female', 'male')),
+        }
+
+    def _playlist(self, index: int) -> Dict:
+        # Track IDs are opaque to the app here, so catalogue titles stand in for them
+        songs = self._random.sample(range(CATALOGUE_SONGS), self._random.choice((20, 50, 150)))
+        return {"name": f"Bench playlist {index}", "songs": [song(number)[0].replace(' ', '') for number in songs]}
+
+    def _artist_query(self) -> str:
+        return artist_name(self._random.randrange(CATALOGUE_ARTISTS))[:self._random.choice((4, 8, 10))]
+
+    def pick(self, pool: List):
+        with self._lock:
+            return self._random.choice(pool)
+
+
+def _request_for(scenario: str, payloads: Payloads) -> Callable[[requests.Session, str], requests.Response]:
+    if scenario == 'search-songs':
+        return lambda http, url: http.post(f"{url}/search-songs", json=payloads.pick(payloads.song_requests))
+    if scenario == 'search-songs-batch':
+        return lambda http, url: http.post(f"{url}/search-songs/batch", json={
+            "specs": [payloads.pick(payloads.song_requests) for _ in range(BATCH_SPECS)]})
+    if scenario == 'create-playlist':
+        return lambda http, url: http.post(f"{url}/create-playlist", json=payloads.pick(payloads.playlists))
+    if scenario == 'search-artists':
+        return lambda http, url: http.get(f"{url}/search-artists",
+                                          params={"query": payloads.pick(payloads.artist_queries)})
+    if scenario == 'available-genres':
+        return lambda http, url: http.get(f"{url}/available-genres")
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+
+def login(url: str, user: int, cookie_name: str) -> requests.Session:
+    """A session logged in through the OAuth callback, as the frontend would be."""
+    http = requests.Session()
+    response = http.get(f"{url}/callback", params={"code": f"bench-user-{user}"}, allow_redirects=False)
+    if response.status_code >= 400 or cookie_name not in response.cookies:
+        raise RuntimeError(f"Login failed with {response.status_code}: {response.text[:200]}")
+    # Set explicitly: the session cookie is marked Secure and the bench talks plain HTTP
+    http.cookies.set(cookie_name, response.cookies[cookie_name])
+    return http
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return float('nan')
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_level(url: str, scenario: str, concurrency: int, total: int, sessions: List[requests.Session],
+              payloads: Payloads) -> Dict:
+    send = _request_for(scenario, payloads)
+    remaining = [total]
+    lock = threading.Lock()
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+
+    def worker(http: requests.Session):
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            started = time.perf_counter()
+            try:
+                status = str(send(http, url).status_code)
+            except requests.RequestException as error:
+                status = type(error).__name__
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(sessions[index],), daemon=True) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    errors = sum(count for status, count in statuses.items() if not status.startswith(('2', '3')))
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(wall, 3),
+        "throughput": round(len(latencies) / wall, 2) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "statuses": statuses,
+    }
+
+
+def serve_app(environment: Dict[str, str], workdir: str) -> str:
+    """Import the app against the stand-ins and serve it on a threaded server; returns its URL."""
+    os.environ.update(environment)
+    os.environ.setdefault('CACHE_DB_PATH', os.path.join(workdir, 'cache.sqlite3'))
+    os.environ.setdefault('CANDIDATE_INDEX_PATH', os.path.join(workdir, 'cache.sqlite3'))
+    # Session files use paths relative to the working directory
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    from werkzeug.serving import make_server
+
+    from app import create_app
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True, name='bench-app').start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def wait_until_ready(url: str, timeout: float = 30.0) -> float:
+    """Poll /ready until the app has warmed up; returns how long that took."""
+    started = time.perf_counter()
+    while True:
+        try:
+            if requests.get(f"{url}/ready", timeout=timeout).status_code == 200:
+                return time.perf_counter() - started
+        except requests.RequestException:
+            pass
+        if time.perf_counter() - started > timeout:
+            raise RuntimeError(f"{url} was not ready after {timeout:.0f}s")
+        time.sleep(0.05)
+
+
+def format_table(results: List[Dict]) -> str:
+    header = f"{'scenario':<18}{'conc':>6}{'reqs':>7}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    lines = [header, '-' * len(header)]
+    for result in results:
+        lines.append(f"{result['scenario']:<18}{result['concurrency']:>6}{result['requests']:>7}{result['errors']:>8}"
+                     f"{result['throughput']:>10.2f}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}"
+                     f"{result['p99_ms']:>10.1f}")
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated; default: all')
+    parser.add_argument('--concurrency', default='1,4,16', help='comma-separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=100, help='requests per scenario and level')
+    parser.add_argument('--warmup', type=int, default=0, help='unmeasured requests per scenario before the levels')
+    parser.add_argument('--distinct', type=int, default=50, help='distinct payloads per scenario')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--set', action='append', default=[], metavar='UPSTREAM.FIELD=VALUE',
+                        help='override a stand-in profile setting, e.g. spotify_api.rate_limit=50')
+    parser.add_argument('--target', help='URL of an already running server instead of an in-process one')
+    parser.add_argument('--cookie-name', default='replit_session_cookie')
+    parser.add_argument('--json', dest='json_path', help='also write the results to this file')
+    args = parser.parse_args(argv)
+    json_path = os.path.abspath(args.json_path) if args.json_path else None
+
+    scenarios = [scenario for scenario in args.scenarios.split(',') if scenario]
+    levels = [int(level) for level in args.concurrency.split(',') if level]
+    for scenario in scenarios:
+        _request_for(scenario, None)
+
+    upstreams = None
+    if args.target:
+        url = args.target.rstrip('/')
+    else:
+        upstreams = FakeUpstreams(profiles=parse_profile_overrides(args.set), seed=args.seed)
+        url = serve_app(upstreams.start(), tempfile.mkdtemp(prefix='sp-bench-'))
+
+    print(f"ready after {wait_until_ready(url):.2f}s", file=sys.stderr)
+    payloads = Payloads(args.seed, args.distinct)
+    sessions = [login(url, user, args.cookie_name) for user in range(max(levels))]
+    results = []
+    for scenario in scenarios:
+        if args.warmup:
+            run_level(url, scenario, min(levels), args.warmup, sessions, payloads)
+        for level in levels:
+            result = run_level(url, scenario, level, args.requests, sessions, payloads)
+            results.append(result)
+            print(f"{scenario} x{level}: {result['throughput']:.2f} req/s, p95 {result['p95_ms']:.1f} ms",
+                  file=sys.stderr)
+
+    print(format_table(results))
+    report = {"seed": args.seed, "results": results}
+    if upstreams is not None:
+        report["upstream_calls"] = upstreams.call_counts()
+        print("\nupstream calls:", json.dumps(report["upstream_calls"]))
+    if json_path:
+        with open(json_path, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,11 @@ class Config:
     # Secret Key
     SECRET_KEY = 'your_secret_key_here'  # Make sure to keep this secret and unique
 
-    SESSION_TYPE = 'filesystem'
+    # 'sqlite' and 'memory' use app.sessions; any other value is handed to Flask-Session
+    SESSION_TYPE = 'sqlite'
+    SESSION_SQLITE_PATH = 'sessions.sqlite3'
+    SESSION_SWEEP_INTERVAL = 600  # Seconds between purges of expired sessions
+    CACHE_SWEEP_INTERVAL = 600  # Seconds between purges of expired (and excess) cache entries
     # Session Configuration
     SESSION_COOKIE_NAME = 'replit_session_cookie'
     SESSION_COOKIE_SAMESITE = 'Lax'  # Lax is a safer default than None
@@ -13,4 +17,19 @@ class Config:
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SECURE = True  # Since you're using HTTPS
     SESSION_PERMANENT = True
-    PERMANENT_SESSION_LIFETIME = timedelta(days=7)  # Set session to 7 days
\ No newline at end of file
+    PERMANENT_SESSION_LIFETIME = timedelta(days=7)  # Set session to 7 days
+
+    # Add a Server-Timing breakdown to every response, not only those requested with X-Server-Timing
+    SERVER_TIMING_HEADER = False
+
+    # gzip (or brotli, when installed) for buffered JSON and text responses of at least COMPRESS_MIN_SIZE bytes
+    COMPRESS_RESPONSES = True
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_GZIP_LEVEL = 6
+    COMPRESS_BR_QUALITY = 4
+
+    # Build the upstream clients, open their connections and prime the genre and artist caches in
+    # the background in each worker process, on its first request or from a post-fork hook calling
+    # app.warmup.start_worker; /ready answers 503 until that is done. None warms every client.
+    WARM_UP_ON_START = True
+    WARM_UP_SERVICES = None